@@ -1,219 +1,4215 @@
+import bisect
 import contextlib
+import sys
 import requests
 import datetime
+import html
 import json
+import time
 import asyncio
 import logging
-from aiogram import Dispatcher
+import logging.handlers
+import atexit
+import contextvars
+import gzip
+import heapq
+import itertools
+import queue
+import shutil
+import tempfile
+import threading
+import hmac
+import multiprocessing
+import signal
 from aiohttp import ClientTimeout
+from array import array
 
-dp = Dispatcher()
-
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.types import Message, CallbackQuery, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Update, Message, CallbackQuery, ReplyParameters, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command, ChatMemberUpdatedFilter, IS_NOT_MEMBER, IS_MEMBER, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.types import BufferedInputFile
+from aiogram.types import BufferedInputFile, FSInputFile
+from aiogram.types.update import UpdateTypeLookupError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 import os
-import backoff
 import aiohttp
+from aiohttp import web
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from dotenv import load_dotenv
-from typing import Dict, Any, TypedDict, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator, Callable, Awaitable, Iterator
 import csv
+from collections import OrderedDict, defaultdict, deque
 from io import StringIO
 
-# Настройка расширенного логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 
-# Типизованные данные
-class UserContext(TypedDict):
-    messages: List[Dict[str, str]]
-    message_count: int
-    last_active: str
-    banned: bool
+# Типизованные данные
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+
+
+class UserContext:
+    """Компактный контекст пользователя.
+
+    Слоты вместо словаря, время активности - целые секунды epoch, история -
+    ограниченный кортеж пар (роль, текст) с интернированными ролями. Кортеж,
+    а не deque: пустая deque сама по себе занимает ~600 байт.
+    """
+
+    __slots__ = ("history", "summary", "message_count", "last_active", "banned", "blocked", "touched")
+
+    def __init__(self, history=(), summary: str = "", message_count: int = 0, last_active: int = 0,
+                 banned: bool = False, blocked: bool = False):
+        self.history: tuple = ()
+        self.summary = summary
+        self.message_count = message_count
+        self.last_active = last_active
+        self.banned = banned
+        self.blocked = blocked  # Пользователь заблокировал бота
+        self.touched = 0.0  # Последнее обращение в горячем кэше (time.monotonic), не сохраняется
+        for role, content in history:
+            self.append_turn(role, content)
+
+    def append_turn(self, role: str, content: str):
+        self.history = (self.history + ((sys.intern(role), content),))[-CONTEXT_MAX_MESSAGES:]
+
+    def drop_oldest(self, count: int):
+        self.history = self.history[count:]
+
+    def assign(self, other: "UserContext"):
+        """Переносит сохраненные поля из другого контекста; сам объект остается прежним"""
+        self.history, self.summary, self.message_count = other.history, other.summary, other.message_count
+        self.last_active, self.banned, self.blocked = other.last_active, other.banned, other.blocked
+
+    def to_row(self) -> Dict[str, Any]:
+        """Значения колонок таблицы users"""
+        return {
+            "messages": json.dumps(self.history, ensure_ascii=False, separators=(",", ":")),
+            "summary": self.summary,
+            "message_count": self.message_count,
+            "last_active_at": self.last_active,
+            "banned": self.banned,
+            "blocked": self.blocked
+        }
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "UserContext":
+        return cls(json.loads(row["messages"]), row["summary"], row["message_count"], row["last_active_at"],
+                   bool(row["banned"]), bool(row["blocked"]))
+
+
+# Настройка логирования: запись в файл и консоль идет в фоновом потоке
+class LogRing:
+    """Кольцевой буфер последних записей лога для админки (фиксированный размер)"""
+
+    def __init__(self, size: int):
+        self._records: deque = deque(maxlen=size)  # (created, levelno, levelname, name, user_id, message)
+        self._lock = threading.Lock()
+
+    def add(self, record: logging.LogRecord):
+        with self._lock:
+            self._records.append((record.created, record.levelno, record.levelname, record.name,
+                                  getattr(record, "user_id", None), record.getMessage()))
+
+    def select(self, min_level: int = logging.NOTSET, user_id: Optional[int] = None,
+               limit: int = 100) -> List[tuple]:
+        """Последние limit записей не ниже min_level (и только пользователя user_id), от старых к новым"""
+        selected = []
+        with self._lock:
+            for entry in reversed(self._records):
+                if entry[1] < min_level or (user_id is not None and entry[4] != user_id):
+                    continue
+                selected.append(entry)
+                if len(selected) >= limit:
+                    break
+        return selected[::-1]
+
+    def export(self, min_level: int = logging.NOTSET, user_id: Optional[int] = None, limit: int = 100) -> bytes:
+        lines = (
+            f"{datetime.datetime.fromtimestamp(created):%Y-%m-%d %H:%M:%S} - {levelname} - {name}"
+            f"{f' - user {uid}' if uid else ''} - {message}"
+            for created, _, levelname, name, uid, message in self.select(min_level, user_id, limit)
+        )
+        return "\n".join(lines).encode()
+
+    def __len__(self):
+        return len(self._records)
+
+
+class LogRingHandler(logging.Handler):
+    def __init__(self, ring: LogRing):
+        super().__init__()
+        self.ring = ring
+
+    def emit(self, record: logging.LogRecord):
+        self.ring.add(record)
+
+
+# ID пользователя текущего апдейта; попадает в каждую запись лога
+current_user_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_user_id", default=None)
+
+
+class UserIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "user_id"):
+            record.user_id = current_user_id.get()
+        return True
+
+
+def gzip_rotator(source: str, dest: str):
+    """Сжимает ротированный файл лога (выполняется в потоке QueueListener)"""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Обработчики логов работают в отдельном потоке, цикл событий только кладет записи в очередь"""
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.namer = lambda name: f"{name}.gz"
+    file_handler.rotator = gzip_rotator
+    console_handler = logging.StreamHandler()
+    ring_handler = LogRingHandler(logs_buffer)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(UserIdFilter())
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    # Уровни по модулям: LOG_LEVELS="aiogram=WARNING,app=DEBUG"
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(
+        queue_handler.queue, file_handler, console_handler, ring_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# Загрузка переменных окружения
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiogram.event=WARNING,aiosqlite=WARNING")
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_RING_SIZE = int(os.getenv("LOG_RING_SIZE", 5000))
+
+# Инициализация контекстов
+admin_context = {}
+logs_buffer = LogRing(LOG_RING_SIZE)
+log_listener = setup_logging()
+logger.info("Environment variables loaded")
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+API_URL = os.getenv("API_URL")
+API_KEY = os.getenv("API_KEY")
+ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+
+if not all([BOT_TOKEN, API_URL, API_KEY, ADMIN_ID]):
+    logger.critical("Missing required environment variables")
+    raise ValueError("Missing required environment variables")
+
+logger.info(f"Admin ID configured as: {ADMIN_ID}")
+
+# Параметры пула соединений LLM API
+LLM_POOL_LIMIT = int(os.getenv("LLM_POOL_LIMIT", 100))
+LLM_POOL_LIMIT_PER_HOST = int(os.getenv("LLM_POOL_LIMIT_PER_HOST", 50))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", 75))
+LLM_DNS_CACHE_TTL = int(os.getenv("LLM_DNS_CACHE_TTL", 300))
+LLM_WARMUP_CONNECTIONS = int(os.getenv("LLM_WARMUP_CONNECTIONS", 2))
+
+# Модель и резервный API: при медленном или недоступном основном запрос дублируется туда
+LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-ai/DeepSeek-V3")
+FALLBACK_API_URL = os.getenv("FALLBACK_API_URL")
+FALLBACK_API_KEY = os.getenv("FALLBACK_API_KEY", API_KEY)
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL", LLM_MODEL)
+
+# Дедлайн запроса: p95 успешных запросов команды * LLM_DEADLINE_FACTOR в пределах [MIN, MAX]
+LLM_DEADLINE_MIN = float(os.getenv("LLM_DEADLINE_MIN", 15))
+LLM_DEADLINE_MAX = float(os.getenv("LLM_DEADLINE_MAX", 120))
+LLM_DEADLINE_FACTOR = float(os.getenv("LLM_DEADLINE_FACTOR", 2))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"  # Дублировать запрос, если основной API медленнее своего p95
+
+# Размыкатель: после стольких ошибок подряд API считается недоступным до успешной пробы
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_PROBE_INTERVAL = float(os.getenv("LLM_BREAKER_PROBE_INTERVAL", 15))
+
+# Потоковая выдача ответов
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))  # Личные чаты
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", 3.5))  # Группы: ~20 правок в минуту
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", 40))
+
+# Доставка ответов: длинный ответ делится по абзацам на несколько сообщений
+MESSAGE_LIMIT = 4096  # Лимит Telegram на текст сообщения
+ANSWER_MAX_CHARS = 4 * MESSAGE_LIMIT  # Ответ API длиннее обрезается
+SEND_INTERVAL = float(os.getenv("SEND_INTERVAL", 1))  # Пауза между частями ответа в личном чате
+SEND_GROUP_INTERVAL = float(os.getenv("SEND_GROUP_INTERVAL", 3))  # В группе: ~20 сообщений в минуту
+
+# Планировщик запросов к LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 200))
+
+# Очередь заданий оракула в хранилище: переживает перезапуск, при остановке дорабатывается
+LLM_JOB_WORKERS = int(os.getenv("LLM_JOB_WORKERS", LLM_MAX_CONCURRENCY))  # 0 - процесс только принимает задания
+LLM_JOB_LEASE = float(os.getenv("LLM_JOB_LEASE", 300))
+LLM_JOB_MAX_ATTEMPTS = int(os.getenv("LLM_JOB_MAX_ATTEMPTS", 3))
+LLM_JOB_POLL_INTERVAL = float(os.getenv("LLM_JOB_POLL_INTERVAL", 2))
+LLM_JOB_DRAIN_TIMEOUT = float(os.getenv("LLM_JOB_DRAIN_TIMEOUT", 25))  # Heroku ждет 30 с после SIGTERM
+
+# Память диалога: бюджеты в токенах
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_HISTORY_TOKENS = int(os.getenv("CONTEXT_HISTORY_TOKENS", 3000))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", 256))
+CONTEXT_MAX_MESSAGES = 40
+
+# Статус «печатает»: Telegram показывает его ~5 секунд
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", 4.5))
+
+# Кэш ответов для команд с аргументом (/знак, /артефакт, /анализ)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 5000))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Пул заранее сгенерированных ответов для команд без аргументов (/предсказание, /эмоции)
+RESPONSE_POOL_SIZE = int(os.getenv("RESPONSE_POOL_SIZE", 8))  # 0 - отключить
+RESPONSE_POOL_TTL = float(os.getenv("RESPONSE_POOL_TTL", 6 * 3600))
+RESPONSE_POOL_HOURLY_BUDGET = int(os.getenv("RESPONSE_POOL_HOURLY_BUDGET", 60))
+RESPONSE_POOL_REFILL_INTERVAL = float(os.getenv("RESPONSE_POOL_REFILL_INTERVAL", 10))
+
+# Хранилище пользователей: memory://, sqlite+aiosqlite:///файл или postgres://...
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///oracle.db")
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", 5))
+USER_FLUSH_BATCH_SIZE = int(os.getenv("USER_FLUSH_BATCH_SIZE", 500))
+USER_IDLE_TTL = float(os.getenv("USER_IDLE_TTL", 3600))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", 100000))
+ADMIN_STATS_REFRESH_INTERVAL = float(os.getenv("ADMIN_STATS_REFRESH_INTERVAL", 60))  # Перечитывание счетчиков админки при WEB_WORKERS > 1
+
+# Рассылки: лимит Telegram ~30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 16))
+BROADCAST_CHECKPOINT_SIZE = int(os.getenv("BROADCAST_CHECKPOINT_SIZE", 200))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+
+# Индекс профилей для поиска в админке
+PROFILE_TTL = float(os.getenv("PROFILE_TTL", 7 * 24 * 3600))
+PROFILE_REFRESH_CONCURRENCY = int(os.getenv("PROFILE_REFRESH_CONCURRENCY", 4))
+PROFILE_REFRESH_RATE = float(os.getenv("PROFILE_REFRESH_RATE", 5))
+
+# Ограничение частоты запросов: команды оракула (LLM) и меню/кнопки считаются отдельно
+THROTTLE_USER_LLM_PER_MINUTE = float(os.getenv("THROTTLE_USER_LLM_PER_MINUTE", 6))
+THROTTLE_USER_MENU_PER_MINUTE = float(os.getenv("THROTTLE_USER_MENU_PER_MINUTE", 30))
+THROTTLE_CHAT_LLM_PER_MINUTE = float(os.getenv("THROTTLE_CHAT_LLM_PER_MINUTE", 20))
+THROTTLE_CHAT_MENU_PER_MINUTE = float(os.getenv("THROTTLE_CHAT_MENU_PER_MINUTE", 60))
+THROTTLE_LLM_BURST = float(os.getenv("THROTTLE_LLM_BURST", 3))
+THROTTLE_MENU_BURST = float(os.getenv("THROTTLE_MENU_BURST", 10))
+LLM_COMMANDS = {"oracle", "анализ", "эмоции", "знак", "артефакт", "предсказание"}
+
+# Выгрузка пользователей: размер пачки, читаемой из хранилища и сжимаемой за раз
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+
+# Метрики Prometheus: METRICS_PORT=0 отключает эндпоинт
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+# Собственный сервер Bot API (локальный telegram-bot-api или заглушка в бенчмарках)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Режим вебхука: если задан WEBHOOK_URL, апдейты принимаются по HTTP вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))  # Апдейтов в очереди одного процесса
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))  # Процессов-обработчиков за одним портом
+WORKER_ID = int(os.getenv("WORKER_ID", 0))  # Номер процесса-обработчика, задается автоматически
+
+# Диспетчер апдейтов: апдейты одного чата по очереди, разных чатов - параллельно в пределах пула
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+UPDATE_FAST_RESERVE = int(os.getenv("UPDATE_FAST_RESERVE", max(1, UPDATE_CONCURRENCY // 4)))  # Слоты только для меню и кнопок
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 10000))  # Ожидающих апдейтов всего
+UPDATE_CHAT_QUEUE_SIZE = int(os.getenv("UPDATE_CHAT_QUEUE_SIZE", 20))  # Ожидающих апдейтов одного чата
+UPDATE_OVERFLOW = os.getenv("UPDATE_OVERFLOW", "wait")  # wait - задержать прием апдейтов, drop - отбросить
+UPDATE_CHAT_OVERFLOW = os.getenv("UPDATE_CHAT_OVERFLOW", "drop_oldest")  # drop_oldest или drop_new
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 10))  # Long polling getUpdates, сек
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    logger.critical("WEBHOOK_SECRET is required in webhook mode")
+    raise ValueError("WEBHOOK_SECRET is required in webhook mode")
+if WEB_WORKERS > 1 and (not WEBHOOK_URL or DATABASE_URL == "memory://"):
+    # Процессы делят контексты и состояния FSM только через общую базу
+    logger.critical("WEB_WORKERS > 1 requires webhook mode and a shared DATABASE_URL")
+    raise ValueError("WEB_WORKERS > 1 requires webhook mode and a shared DATABASE_URL")
+if UPDATE_OVERFLOW not in ("wait", "drop") or UPDATE_CHAT_OVERFLOW not in ("drop_oldest", "drop_new"):
+    logger.critical(f"Unknown overflow policy: {UPDATE_OVERFLOW}/{UPDATE_CHAT_OVERFLOW}")
+    raise ValueError("UPDATE_OVERFLOW must be wait or drop, UPDATE_CHAT_OVERFLOW - drop_oldest or drop_new")
+if not 0 <= UPDATE_FAST_RESERVE < UPDATE_CONCURRENCY or UPDATE_CHAT_QUEUE_SIZE < 1:
+    logger.critical("UPDATE_FAST_RESERVE must be below UPDATE_CONCURRENCY, UPDATE_CHAT_QUEUE_SIZE at least 1")
+    raise ValueError("Invalid update dispatcher limits")
+
+# Инициализация бота
+router = Router(name="main")
+logger.info("Initializing bot with configurations")
+# Инициализация бота с увеличенными таймаутами
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    session_timeout=300,  # 5 минут
+    read_timeout=300,  # 5 минут
+    connect_timeout=60  # 1 минута для установки соединения
+)
+
+
+# Метрики в формате Prometheus
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Metric:
+    """Базовая метрика с метками; значения хранятся по кортежу значений меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[tuple, Any] = {}
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class ScalarMetric(Metric):
+    """Одно число на набор меток; значение может вычисляться функцией при выгрузке"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        if self.function is not None:
+            self._values[()] = self.function()
+        return super().render()
+
+
+class Counter(ScalarMetric):
+    kind = "counter"
+
+
+class Gauge(ScalarMetric):
+    """Значение задается явно или вычисляется функцией при выгрузке"""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # [счетчики по корзинам..., +Inf, сумма]
+            series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля по корзинам с линейной интерполяцией"""
+        series = self._values.get(self._key(labels))
+        if not series:
+            return None
+        total = sum(series[:-1])
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(series[:-1]):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def count(self, **labels) -> int:
+        series = self._values.get(self._key(labels))
+        return sum(series[:-1]) if series else 0
+
+    def label_values(self) -> List[tuple]:
+        return list(self._values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = f'le="{"+Inf" if bound == float("inf") else bound}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.register(Histogram(
+    "oracle_handler_seconds", "Время обработки апдейта обработчиком", ("handler", "status")))
+handlers_in_flight = metrics.register(Gauge(
+    "oracle_handlers_in_flight", "Обработчики, выполняющиеся сейчас", ("handler",)))
+upstream_seconds = metrics.register(Histogram(
+    "oracle_upstream_seconds", "Время запроса к LLM API", ("upstream", "command", "mode", "status")))
+upstream_in_flight = metrics.register(Gauge(
+    "oracle_upstream_in_flight", "Запросы к LLM API в полете"))
+upstream_retries = metrics.register(Counter(
+    "oracle_upstream_retries_total", "Повторы запросов к LLM API", ("reason",)))
+upstream_hedges = metrics.register(Counter(
+    "oracle_upstream_hedges_total", "Запросы, продублированные в резервный API", ("winner",)))
+upstream_breaker_open = metrics.register(Gauge(
+    "oracle_upstream_breaker_open", "1 - размыкатель API разомкнут, запросы не отправляются", ("upstream",)))
+throttled_updates = metrics.register(Counter(
+    "oracle_throttled_total", "Апдейты, отклоненные ограничением частоты", ("scope", "command_class")))
+llm_tokens = metrics.register(Counter(
+    "oracle_llm_tokens_total", "Токены по полю usage ответа", ("kind",)))
+llm_job_seconds = metrics.register(Histogram(
+    "oracle_llm_job_seconds", "Время от постановки задания оракула до доставки ответа", ("command", "status")))
+bot_api_seconds = metrics.register(Histogram(
+    "oracle_bot_api_seconds", "Время вызовов Telegram Bot API", ("method", "status")))
+dispatch_wait_seconds = metrics.register(Histogram(
+    "oracle_dispatch_wait_seconds", "Ожидание апдейта в очереди диспетчера до обработки", ("lane",)))
+dispatch_running = metrics.register(Gauge(
+    "oracle_dispatch_running", "Апдейты, обрабатываемые сейчас", ("lane",)))
+dispatch_dropped = metrics.register(Counter(
+    "oracle_dispatch_dropped_total", "Апдейты, отброшенные при переполнении очереди диспетчера", ("reason",)))
+# Состояние компонентов снимается в момент выгрузки
+metrics.register(Gauge("oracle_dispatch_queue_depth", "Апдейты в очередях чатов, ожидающие обработки",
+                       function=lambda: update_dispatcher.pending))
+metrics.register(Gauge("oracle_dispatch_ready_chats", "Чаты, ожидающие свободного слота диспетчера",
+                       function=lambda: update_dispatcher.ready_chats))
+metrics.register(Gauge("oracle_dispatch_blocked", "Источники апдейтов, ждущие места в очереди (UPDATE_OVERFLOW=wait)",
+                       function=lambda: len(update_dispatcher.waiters)))
+metrics.register(Gauge("oracle_llm_queue_depth", "Запросы в очереди планировщика",
+                       function=lambda: llm_scheduler.queued))
+metrics.register(Gauge("oracle_llm_scheduler_in_flight", "Запросы, допущенные планировщиком",
+                       function=lambda: llm_scheduler.in_flight))
+metrics.register(Gauge("oracle_llm_jobs_running", "Задания оракула, выполняющиеся в процессе",
+                       function=lambda: len(llm_jobs.running)))
+metrics.register(Counter("oracle_llm_shed_total", "Запросы, отклоненные из-за переполнения очереди",
+                         function=lambda: llm_scheduler.shed))
+metrics.register(Counter("oracle_response_cache_hits_total", "Попадания в кэш ответов",
+                         function=lambda: response_cache.hits + response_cache.coalesced))
+metrics.register(Counter("oracle_response_cache_misses_total", "Промахи кэша ответов",
+                         function=lambda: response_cache.misses))
+metrics.register(Gauge("oracle_cached_users", "Пользователи в горячем кэше",
+                       function=lambda: len(user_repo.cache)))
+
+
+def record_usage(usage: Optional[Dict[str, Any]]):
+    """Учитывает токены из поля usage ответа API"""
+    if not usage:
+        return
+    llm_tokens.inc(usage.get("prompt_tokens", 0), kind="prompt")
+    llm_tokens.inc(usage.get("completion_tokens", 0), kind="completion")
+    # DeepSeek отдает prompt_cache_hit_tokens, OpenAI-совместимые API - prompt_tokens_details.cached_tokens
+    cache_hit = usage.get("prompt_cache_hit_tokens")
+    if cache_hit is None:
+        cache_hit = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cache_hit is not None:
+        llm_tokens.inc(cache_hit, kind="cache_hit")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Гистограмма времени выполнения обработчиков с разбивкой по обработчику"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        handlers_in_flight.inc(handler=name)
+        admin_stats.record_command(name)
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handlers_in_flight.dec(handler=name)
+            handler_seconds.observe(time.perf_counter() - started, handler=name, status=status)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время каждого вызова Bot API (send_message, edit_message_text, ...)"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            status = "retry_after"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            bot_api_seconds.observe(time.perf_counter() - started, method=type(method).__name__, status=status)
+
+
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(BotApiMetricsMiddleware())
+
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """Локальный HTTP-эндпоинт /metrics для Prometheus"""
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+def metrics_summary() -> str:
+    """Краткая сводка метрик для админки"""
+    lines = ["📈 <b>Метрики:</b>"]
+    handlers = sorted({key[0] for key in handler_seconds.label_values()})
+    for name in handlers:
+        count = handler_seconds.count(handler=name, status="ok")
+        if not count:
+            continue
+        p50 = handler_seconds.quantile(0.5, handler=name, status="ok")
+        p95 = handler_seconds.quantile(0.95, handler=name, status="ok")
+        lines.append(f"• {name}: {count} шт., p50 {p50:.2f}с, p95 {p95:.2f}с")
+
+    responses: Dict[tuple, int] = defaultdict(int)
+    for upstream, command, mode, status in upstream_seconds.label_values():
+        responses[upstream, mode, status] += upstream_seconds.count(
+            upstream=upstream, command=command, mode=mode, status=status)
+    statuses = ", ".join(f"{upstream}/{mode}/{status}: {count}"
+                         for (upstream, mode, status), count in sorted(responses.items()))
+    lines.append(f"🌐 Ответы API: {statuses or 'нет'}")
+    lines.append(f"🔁 Повторы: {upstream_retries.total():.0f}, дублей: {upstream_hedges.total():.0f}, "
+                 f"в полете: {upstream_in_flight.value():.0f}")
+    prompt_tokens = llm_tokens.value(kind="prompt")
+    cache_hit = llm_tokens.value(kind="cache_hit")
+    lines.append(
+        f"🔤 Токены: запрос {prompt_tokens:.0f}, ответ {llm_tokens.value(kind='completion'):.0f}, "
+        f"из кэша префиксов {cache_hit:.0f} ({cache_hit / prompt_tokens:.0%})" if prompt_tokens else
+        "🔤 Токены: запросов еще не было"
+    )
+    return "\n".join(lines)
+
+
+# Хранилище контекстов пользователей
+class UserStore:
+    """Базовый интерфейс хранилища контекстов пользователей"""
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def load(self, user_id: int) -> Optional[UserContext]:
+        raise NotImplementedError
+
+    async def upsert(self, rows: Dict[int, UserContext], with_banned: bool = False):
+        """Сохраняет пачку контекстов. Флаг banned пишется только при with_banned,
+        чтобы отложенная запись не затерла бан, выставленный другим процессом."""
+        raise NotImplementedError
+
+    async def iter_users(self, chunk_size: int = 1000) -> AsyncIterator[List[tuple]]:
+        """Отдает пользователей пачками [(user_id, context), ...] в порядке user_id"""
+        raise NotImplementedError
+        yield
+
+    async def stats(self) -> Dict[str, int]:
+        """Общее число и заблокированные пользователи"""
+        raise NotImplementedError
+
+    async def iter_export_rows(self, active_since: Optional[int] = None, banned_only: bool = False,
+                               min_messages: int = 0, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        """Строки выгрузки пачками [(user_id, last_active, message_count, banned), ...] в порядке user_id.
+        Фильтры применяются в хранилище, история диалога не читается."""
+        raise NotImplementedError
+        yield
+
+    async def activity_histogram(self, since: int, bucket_seconds: int) -> Dict[int, int]:
+        """Число пользователей по корзинам времени последней активности: {начало // bucket_seconds: count}"""
+        raise NotImplementedError
+
+    async def changed_since(self, since_ms: int) -> List[int]:
+        """ID пользователей, чьи контексты после since_ms (мс epoch) сохранили другие процессы"""
+        raise NotImplementedError
+
+    async def get_fsm(self, key: str) -> Optional[tuple]:
+        """Состояние FSM (state, data) по ключу aiogram или None"""
+        raise NotImplementedError
+
+    async def set_fsm(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        """Сохраняет состояние FSM; пустое состояние удаляется"""
+        raise NotImplementedError
+
+    async def get_meta(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set_meta(self, key: str, value: str):
+        raise NotImplementedError
+
+    async def create_broadcast(self, text: str, admin_chat_id: int) -> int:
+        raise NotImplementedError
+
+    async def update_broadcast(self, broadcast_id: int, **fields):
+        raise NotImplementedError
+
+    async def unfinished_broadcasts(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def processed_recipients(self, broadcast_id: int) -> set:
+        """ID получателей, которые уже обработаны рассылкой (для возобновления)"""
+        raise NotImplementedError
+
+    async def record_recipients(self, broadcast_id: int, results: List[tuple]):
+        """Чекпоинт рассылки: [(user_id, status), ...]"""
+        raise NotImplementedError
+
+    async def upsert_profiles(self, rows: Dict[int, tuple]):
+        """Профили: user_id -> (first_name, last_name, username, updated_at)"""
+        raise NotImplementedError
+
+    async def create_job(self, fields: Dict[str, Any]) -> int:
+        """Новое задание оракула в статусе queued"""
+        raise NotImplementedError
+
+    async def claim_jobs(self, limit: int, now: float, lease_until: float, worker: int,
+                         shards: int = 1) -> List[Dict[str, Any]]:
+        """Забирает до limit заданий: ожидающие, чье время подошло, и те, у которых истекла аренда.
+
+        При shards > 1 - только задания чатов с chat_id % shards == worker: контекст
+        пользователя меняет тот же процесс, что обрабатывает апдейты его чата.
+        """
+        raise NotImplementedError
+
+    async def save_job_answer(self, job_id: int, answer: str) -> bool:
+        """Сохраняет ответ, если его еще нет; False - ответ уже сохранил другой запуск задания"""
+        raise NotImplementedError
+
+    async def update_job(self, job_id: int, **fields):
+        raise NotImplementedError
+
+    async def renew_jobs(self, job_ids: List[int], lease_until: float):
+        raise NotImplementedError
+
+    async def release_jobs(self, job_ids: List[int]):
+        """Возвращает прерванные остановкой задания в очередь; попытка не засчитывается"""
+        raise NotImplementedError
+
+    async def purge_jobs(self, before: float) -> int:
+        """Удаляет завершенные задания, созданные раньше before"""
+        raise NotImplementedError
+
+    async def iter_profiles(self, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        raise NotImplementedError
+        yield
+
+
+class MemoryUserStore(UserStore):
+    """Хранилище в памяти процесса (для разработки и тестов).
+
+    Записи лежат кортежами значений колонок - так выгруженные из горячего
+    кэша пользователи занимают меньше памяти.
+    """
+
+    COLUMNS = ("messages", "summary", "message_count", "last_active_at", "banned", "blocked")
+
+    def __init__(self):
+        self._rows: Dict[int, tuple] = {}
+        self._broadcasts: Dict[int, Dict[str, Any]] = {}
+        self._recipients: Dict[int, Dict[int, str]] = {}
+        self._profiles: Dict[int, tuple] = {}
+        self._meta: Dict[str, str] = {}
+        self._fsm: Dict[str, tuple] = {}
+        self._jobs: Dict[int, Dict[str, Any]] = {}
+        self._job_id = 0
+
+    def _to_context(self, row: tuple) -> UserContext:
+        return UserContext.from_row(dict(zip(self.COLUMNS, row)))
+
+    async def load(self, user_id: int) -> Optional[UserContext]:
+        row = self._rows.get(user_id)
+        return self._to_context(row) if row is not None else None
+
+    async def upsert(self, rows: Dict[int, UserContext], with_banned: bool = False):
+        for user_id, context in rows.items():
+            values = context.to_row()
+            if not with_banned and user_id in self._rows:
+                values["banned"] = self._rows[user_id][4]
+            self._rows[user_id] = tuple(values[name] for name in self.COLUMNS)
+
+    async def iter_users(self, chunk_size: int = 1000) -> AsyncIterator[List[tuple]]:
+        user_ids = sorted(self._rows)
+        for i in range(0, len(user_ids), chunk_size):
+            yield [(user_id, self._to_context(self._rows[user_id])) for user_id in user_ids[i:i + chunk_size]]
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            "total": len(self._rows),
+            "banned": sum(1 for row in self._rows.values() if row[4])
+        }
+
+    async def iter_export_rows(self, active_since: Optional[int] = None, banned_only: bool = False,
+                               min_messages: int = 0, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        user_ids = sorted(self._rows)
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = []
+            for user_id in user_ids[i:i + chunk_size]:
+                _, _, message_count, last_active, banned, _ = self._rows[user_id]
+                if active_since is not None and last_active < active_since:
+                    continue
+                if (banned_only and not banned) or message_count < min_messages:
+                    continue
+                chunk.append((user_id, last_active, message_count, banned))
+            if chunk:
+                yield chunk
+
+    async def activity_histogram(self, since: int, bucket_seconds: int) -> Dict[int, int]:
+        histogram: Dict[int, int] = {}
+        for row in self._rows.values():
+            if row[3] and row[3] >= since:
+                bucket = row[3] // bucket_seconds
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+        return histogram
+
+    async def changed_since(self, since_ms: int) -> List[int]:
+        return []  # Хранилище в памяти доступно только своему процессу
+
+    async def get_fsm(self, key: str) -> Optional[tuple]:
+        return self._fsm.get(key)
+
+    async def set_fsm(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            self._fsm.pop(key, None)
+        else:
+            self._fsm[key] = (state, dict(data))
+
+    async def get_meta(self, key: str) -> Optional[str]:
+        return self._meta.get(key)
+
+    async def set_meta(self, key: str, value: str):
+        self._meta[key] = value
+
+    async def create_broadcast(self, text: str, admin_chat_id: int) -> int:
+        broadcast_id = len(self._broadcasts) + 1
+        self._broadcasts[broadcast_id] = {
+            "id": broadcast_id, "text": text, "admin_chat_id": admin_chat_id,
+            "progress_message_id": None, "status": "running", "sent": 0, "failed": 0, "blocked": 0
+        }
+        self._recipients[broadcast_id] = {}
+        return broadcast_id
+
+    async def update_broadcast(self, broadcast_id: int, **fields):
+        self._broadcasts[broadcast_id].update(fields)
+
+    async def unfinished_broadcasts(self) -> List[Dict[str, Any]]:
+        return [dict(b) for b in self._broadcasts.values() if b["status"] == "running"]
+
+    async def processed_recipients(self, broadcast_id: int) -> set:
+        return set(self._recipients.get(broadcast_id, {}))
+
+    async def record_recipients(self, broadcast_id: int, results: List[tuple]):
+        self._recipients.setdefault(broadcast_id, {}).update(results)
+
+    async def upsert_profiles(self, rows: Dict[int, tuple]):
+        self._profiles.update(rows)
+
+    async def iter_profiles(self, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        items = list(self._profiles.items())
+        for i in range(0, len(items), chunk_size):
+            yield items[i:i + chunk_size]
+
+    async def create_job(self, fields: Dict[str, Any]) -> int:
+        self._job_id += 1
+        self._jobs[self._job_id] = {
+            "message_id": None, "cached": False, "attempts": 0, "available_at": 0.0,
+            "lease_until": None, "worker": None, "answer": None, "parts_sent": 0, **fields, "id": self._job_id, "status": "queued"
+        }
+        return self._job_id
+
+    async def claim_jobs(self, limit: int, now: float, lease_until: float, worker: int,
+                         shards: int = 1) -> List[Dict[str, Any]]:
+        claimed = []
+        for job in self._jobs.values():
+            if len(claimed) >= limit:
+                break
+            if job["chat_id"] % shards != worker:
+                continue
+            if ((job["status"] == "queued" and job["available_at"] <= now)
+                    or (job["status"] == "running" and job["lease_until"] < now)):
+                job.update(status="running", lease_until=lease_until, worker=worker, attempts=job["attempts"] + 1)
+                claimed.append(dict(job))
+        return claimed
+
+    async def save_job_answer(self, job_id: int, answer: str) -> bool:
+        job = self._jobs[job_id]
+        if job["answer"] is not None:
+            return False
+        job["answer"] = answer
+        return True
+
+    async def update_job(self, job_id: int, **fields):
+        self._jobs[job_id].update(fields)
+
+    async def renew_jobs(self, job_ids: List[int], lease_until: float):
+        for job_id in job_ids:
+            self._jobs[job_id]["lease_until"] = lease_until
+
+    async def release_jobs(self, job_ids: List[int]):
+        for job_id in job_ids:
+            job = self._jobs[job_id]
+            job.update(status="queued", lease_until=None, attempts=job["attempts"] - 1)
+
+    async def purge_jobs(self, before: float) -> int:
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job["status"] in ("done", "failed") and job["created_at"] < before]
+        for job_id in finished:
+            del self._jobs[job_id]
+        return len(finished)
+
+
+metadata = sa.MetaData()
+
+users_table = sa.Table(
+    "users", metadata,
+    sa.Column("user_id", sa.BigInteger, primary_key=True, autoincrement=False),
+    sa.Column("messages", sa.Text, nullable=False, default="[]"),
+    sa.Column("summary", sa.Text, nullable=False, default=""),
+    sa.Column("message_count", sa.Integer, nullable=False, default=0),
+    sa.Column("last_active_at", sa.BigInteger, nullable=False, default=0),
+    sa.Column("banned", sa.Boolean, nullable=False, default=False),
+    sa.Column("blocked", sa.Boolean, nullable=False, default=False),
+    # Кто и когда (мс epoch) последним сохранил контекст - для сброса кэшей других процессов
+    sa.Column("updated_at", sa.BigInteger),
+    sa.Column("writer", sa.Integer),
+    sa.Index("ix_users_updated_at", "updated_at")
+)
+
+broadcasts_table = sa.Table(
+    "broadcasts", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column("text", sa.Text, nullable=False),
+    sa.Column("admin_chat_id", sa.BigInteger, nullable=False),
+    sa.Column("progress_message_id", sa.BigInteger),
+    sa.Column("status", sa.String(16), nullable=False, default="running"),
+    sa.Column("sent", sa.Integer, nullable=False, default=0),
+    sa.Column("failed", sa.Integer, nullable=False, default=0),
+    sa.Column("blocked", sa.Integer, nullable=False, default=0)
+)
+
+broadcast_recipients_table = sa.Table(
+    "broadcast_recipients", metadata,
+    sa.Column("broadcast_id", sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column("user_id", sa.BigInteger, primary_key=True, autoincrement=False),
+    sa.Column("status", sa.String(16), nullable=False)
+)
+
+profiles_table = sa.Table(
+    "profiles", metadata,
+    sa.Column("user_id", sa.BigInteger, primary_key=True, autoincrement=False),
+    sa.Column("first_name", sa.String(64), nullable=False, default=""),
+    sa.Column("last_name", sa.String(64), nullable=False, default=""),
+    sa.Column("username", sa.String(32), nullable=False, default=""),
+    sa.Column("updated_at", sa.Integer, nullable=False, default=0)
+)
+
+
+meta_table = sa.Table(
+    "meta", metadata,
+    sa.Column("key", sa.String(64), primary_key=True),
+    sa.Column("value", sa.Text, nullable=False)
+)
+
+jobs_table = sa.Table(
+    "llm_jobs", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column("chat_id", sa.BigInteger, nullable=False),
+    sa.Column("chat_type", sa.String(16), nullable=False),
+    sa.Column("user_id", sa.BigInteger, nullable=False),
+    sa.Column("reply_to", sa.BigInteger, nullable=False),  # Сообщение с командой
+    sa.Column("message_id", sa.BigInteger),  # Заглушка или доставленный ответ
+    sa.Column("prompt", sa.String(32), nullable=False),
+    sa.Column("question", sa.Text, nullable=False, default=""),
+    sa.Column("header", sa.Text, nullable=False, default=""),
+    sa.Column("cached", sa.Boolean, nullable=False, default=False),
+    sa.Column("status", sa.String(16), nullable=False, default="queued"),
+    sa.Column("attempts", sa.Integer, nullable=False, default=0),
+    sa.Column("created_at", sa.Float, nullable=False),
+    sa.Column("available_at", sa.Float, nullable=False, default=0),
+    sa.Column("lease_until", sa.Float),
+    sa.Column("worker", sa.Integer),
+    sa.Column("answer", sa.Text),  # Сохраняется до доставки: повтор не генерирует ответ заново
+    sa.Column("parts_sent", sa.Integer, nullable=False, default=0),  # Доставленные продолжения ответа
+    sa.Index("ix_llm_jobs_status", "status", "available_at")
+)
+
+fsm_table = sa.Table(
+    "fsm_states", metadata,
+    sa.Column("key", sa.String(255), primary_key=True),
+    sa.Column("state", sa.String(255)),
+    sa.Column("data", sa.Text, nullable=False, default="{}")
+)
+
+
+class SQLUserStore(UserStore):
+    """SQL-хранилище: SQLite локально, Postgres в продакшене"""
+
+    def __init__(self, url: str, writer: int = 0):
+        self.url = url
+        self.writer = writer  # Номер процесса, который пишет в колонку users.writer
+        self.engine: Optional[AsyncEngine] = None
+
+    async def open(self):
+        self.engine = create_async_engine(self.url, pool_pre_ping=True)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+        logger.info(f"User store connected: {self.engine.url.render_as_string(hide_password=True)}")
+
+    async def close(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    def _insert(self, table: sa.Table = users_table):
+        if self.engine.dialect.name == "postgresql":
+            return pg_insert(table)
+        return sqlite_insert(table)
+
+    @staticmethod
+    def _to_context(row) -> UserContext:
+        return UserContext.from_row(row._mapping)
+
+    async def load(self, user_id: int) -> Optional[UserContext]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(sa.select(users_table).where(users_table.c.user_id == user_id))
+            row = result.first()
+        return self._to_context(row) if row is not None else None
+
+    async def upsert(self, rows: Dict[int, UserContext], with_banned: bool = False):
+        if not rows:
+            return
+
+        updated_at = int(time.time() * 1000)
+        values = [{"user_id": user_id, "updated_at": updated_at, "writer": self.writer, **context.to_row()}
+                  for user_id, context in rows.items()]
+        statement = self._insert()
+        updated = ["messages", "summary", "message_count", "last_active_at", "blocked", "updated_at", "writer"]
+        if with_banned:
+            updated.append("banned")
+        statement = statement.on_conflict_do_update(
+            index_elements=[users_table.c.user_id],
+            set_={name: statement.excluded[name] for name in updated}
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(statement, values)
+
+    async def iter_users(self, chunk_size: int = 1000) -> AsyncIterator[List[tuple]]:
+        last_id = None
+        while True:
+            query = sa.select(users_table).order_by(users_table.c.user_id).limit(chunk_size)
+            if last_id is not None:
+                query = query.where(users_table.c.user_id > last_id)
+            async with self.engine.connect() as conn:
+                rows = (await conn.execute(query)).all()
+            if not rows:
+                return
+            last_id = rows[-1].user_id
+            yield [(row.user_id, self._to_context(row)) for row in rows]
+
+    async def stats(self) -> Dict[str, int]:
+        query = sa.select(
+            sa.func.count(),
+            sa.func.coalesce(sa.func.sum(sa.case((users_table.c.banned, 1), else_=0)), 0)
+        )
+        async with self.engine.connect() as conn:
+            total, banned = (await conn.execute(query)).one()
+        return {"total": total, "banned": banned}
+
+    async def iter_export_rows(self, active_since: Optional[int] = None, banned_only: bool = False,
+                               min_messages: int = 0, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        columns = users_table.c
+        conditions = []
+        if active_since is not None:
+            conditions.append(columns.last_active_at >= active_since)
+        if banned_only:
+            conditions.append(columns.banned)
+        if min_messages:
+            conditions.append(columns.message_count >= min_messages)
+
+        last_id = None
+        while True:
+            query = (sa.select(columns.user_id, columns.last_active_at, columns.message_count, columns.banned)
+                     .where(*conditions).order_by(columns.user_id).limit(chunk_size))
+            if last_id is not None:
+                query = query.where(columns.user_id > last_id)
+            async with self.engine.connect() as conn:
+                rows = (await conn.execute(query)).all()
+            if not rows:
+                return
+            last_id = rows[-1].user_id
+            yield [(row.user_id, row.last_active_at, row.message_count, bool(row.banned)) for row in rows]
+
+    async def activity_histogram(self, since: int, bucket_seconds: int) -> Dict[int, int]:
+        bucket = users_table.c.last_active_at // bucket_seconds
+        query = (sa.select(bucket, sa.func.count())
+                 .where(users_table.c.last_active_at >= since)
+                 .group_by(bucket))
+        async with self.engine.connect() as conn:
+            return {int(key): count for key, count in await conn.execute(query)}
+
+    async def changed_since(self, since_ms: int) -> List[int]:
+        columns = users_table.c
+        query = sa.select(columns.user_id).where(columns.updated_at > since_ms, columns.writer != self.writer)
+        async with self.engine.connect() as conn:
+            return list((await conn.execute(query)).scalars())
+
+    async def get_fsm(self, key: str) -> Optional[tuple]:
+        query = sa.select(fsm_table.c.state, fsm_table.c.data).where(fsm_table.c.key == key)
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(query)).first()
+        return (row.state, json.loads(row.data)) if row is not None else None
+
+    async def set_fsm(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        async with self.engine.begin() as conn:
+            if state is None and not data:
+                await conn.execute(fsm_table.delete().where(fsm_table.c.key == key))
+                return
+            statement = self._insert(fsm_table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[fsm_table.c.key],
+                set_={"state": statement.excluded.state, "data": statement.excluded.data}
+            )
+            await conn.execute(statement, {"key": key, "state": state,
+                                           "data": json.dumps(data, ensure_ascii=False)})
+
+    async def get_meta(self, key: str) -> Optional[str]:
+        async with self.engine.connect() as conn:
+            return (await conn.execute(sa.select(meta_table.c.value).where(meta_table.c.key == key))).scalar()
+
+    async def set_meta(self, key: str, value: str):
+        statement = self._insert(meta_table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[meta_table.c.key], set_={"value": statement.excluded.value}
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(statement, {"key": key, "value": value})
+
+    async def create_broadcast(self, text: str, admin_chat_id: int) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                broadcasts_table.insert().values(text=text, admin_chat_id=admin_chat_id, status="running")
+            )
+            return result.inserted_primary_key[0]
+
+    async def update_broadcast(self, broadcast_id: int, **fields):
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                broadcasts_table.update().where(broadcasts_table.c.id == broadcast_id).values(**fields)
+            )
+
+    async def unfinished_broadcasts(self) -> List[Dict[str, Any]]:
+        query = sa.select(broadcasts_table).where(broadcasts_table.c.status == "running")
+        async with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in await conn.execute(query)]
+
+    async def processed_recipients(self, broadcast_id: int) -> set:
+        query = sa.select(broadcast_recipients_table.c.user_id).where(
+            broadcast_recipients_table.c.broadcast_id == broadcast_id)
+        async with self.engine.connect() as conn:
+            return set((await conn.execute(query)).scalars())
+
+    async def record_recipients(self, broadcast_id: int, results: List[tuple]):
+        if not results:
+            return
+        statement = self._insert(broadcast_recipients_table).on_conflict_do_nothing()
+        async with self.engine.begin() as conn:
+            await conn.execute(statement, [
+                {"broadcast_id": broadcast_id, "user_id": user_id, "status": status}
+                for user_id, status in results
+            ])
+
+    async def upsert_profiles(self, rows: Dict[int, tuple]):
+        if not rows:
+            return
+        statement = self._insert(profiles_table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[profiles_table.c.user_id],
+            set_={name: statement.excluded[name] for name in ("first_name", "last_name", "username", "updated_at")}
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(statement, [
+                {"user_id": user_id, "first_name": first_name, "last_name": last_name,
+                 "username": username, "updated_at": updated_at}
+                for user_id, (first_name, last_name, username, updated_at) in rows.items()
+            ])
+
+    async def iter_profiles(self, chunk_size: int = 5000) -> AsyncIterator[List[tuple]]:
+        last_id = None
+        while True:
+            query = sa.select(profiles_table).order_by(profiles_table.c.user_id).limit(chunk_size)
+            if last_id is not None:
+                query = query.where(profiles_table.c.user_id > last_id)
+            async with self.engine.connect() as conn:
+                rows = (await conn.execute(query)).all()
+            if not rows:
+                return
+            last_id = rows[-1].user_id
+            yield [(row.user_id, (row.first_name, row.last_name, row.username, row.updated_at)) for row in rows]
+
+    async def create_job(self, fields: Dict[str, Any]) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(jobs_table.insert().values(status="queued", **fields))
+            return result.inserted_primary_key[0]
+
+    async def claim_jobs(self, limit: int, now: float, lease_until: float, worker: int,
+                         shards: int = 1) -> List[Dict[str, Any]]:
+        columns = jobs_table.c
+        claimable = sa.or_(
+            sa.and_(columns.status == "queued", columns.available_at <= now),
+            sa.and_(columns.status == "running", columns.lease_until < now)
+        )
+        if shards > 1:
+            # Остаток как в Python: у групп chat_id отрицательный
+            claimable = sa.and_(claimable, (columns.chat_id % shards + shards) % shards == worker)
+        async with self.engine.begin() as conn:
+            candidates = (await conn.execute(
+                sa.select(columns.id).where(claimable).order_by(columns.id).limit(limit))).scalars().all()
+            claimed = []
+            # Условие повторяется в UPDATE: задание, которое успел забрать другой процесс, пропускается
+            for job_id in candidates:
+                result = await conn.execute(
+                    jobs_table.update().where(columns.id == job_id, claimable)
+                    .values(status="running", lease_until=lease_until, worker=worker, attempts=columns.attempts + 1)
+                )
+                if result.rowcount:
+                    claimed.append(job_id)
+            if not claimed:
+                return []
+            rows = await conn.execute(sa.select(jobs_table).where(columns.id.in_(claimed)).order_by(columns.id))
+            return [dict(row._mapping) for row in rows]
+
+    async def save_job_answer(self, job_id: int, answer: str) -> bool:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                jobs_table.update().where(jobs_table.c.id == job_id, jobs_table.c.answer.is_(None)).values(answer=answer)
+            )
+            return bool(result.rowcount)
+
+    async def update_job(self, job_id: int, **fields):
+        async with self.engine.begin() as conn:
+            await conn.execute(jobs_table.update().where(jobs_table.c.id == job_id).values(**fields))
+
+    async def renew_jobs(self, job_ids: List[int], lease_until: float):
+        if not job_ids:
+            return
+        async with self.engine.begin() as conn:
+            await conn.execute(jobs_table.update().where(jobs_table.c.id.in_(job_ids)).values(lease_until=lease_until))
+
+    async def release_jobs(self, job_ids: List[int]):
+        if not job_ids:
+            return
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                jobs_table.update().where(jobs_table.c.id.in_(job_ids))
+                .values(status="queued", lease_until=None, attempts=jobs_table.c.attempts - 1)
+            )
+
+    async def purge_jobs(self, before: float) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                jobs_table.delete().where(jobs_table.c.status.in_(("done", "failed")), jobs_table.c.created_at < before)
+            )
+            return result.rowcount
+
+
+class UserRepository:
+    """Горячий кэш контекстов поверх хранилища с отложенной пакетной записью.
+
+    Обработчики меняют контексты в памяти и помечают их грязными; фоновая задача
+    раз в USER_FLUSH_INTERVAL секунд сохраняет их пачками. Баны пишутся сразу.
+    При shared (несколько процессов) та же задача подтягивает в кэш контексты,
+    которые сохранили другие процессы.
+    """
+
+    # Перекрытие окон синхронизации: запись, начатая раньше, могла стать видна позже
+    SYNC_OVERLAP_MS = 5000
+
+    def __init__(self, store: UserStore, flush_interval: float, batch_size: int,
+                 idle_ttl: float, max_cached: int, shared: bool = False):
+        self.store = store
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.idle_ttl = idle_ttl
+        self.max_cached = max_cached
+        # Порядок вставки служит LRU: при обращении запись переставляется в конец
+        self.cache: Dict[int, UserContext] = {}
+        self._dirty: Dict[int, UserContext] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._synced_at = 0
+        self.evicted = 0
+
+    async def start(self):
+        await self.store.open()
+        self._synced_at = int(time.time() * 1000)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+        await self.flush()
+        await self.store.close()
+
+    def _touch(self, user_id: int, context: UserContext):
+        now = time.monotonic()
+        # Переставляем не чаще раза в минуту, чтобы не перестраивать словарь на каждом апдейте
+        if now - context.touched > 60:
+            self.cache.pop(user_id, None)
+            self.cache[user_id] = context
+        context.touched = now
+
+    async def get(self, user_id: int, create: bool = True) -> Optional[UserContext]:
+        context = self.cache.get(user_id)
+        if context is not None:
+            self._touch(user_id, context)
+            return context
+
+        loaded = await self.store.load(user_id)
+        # Пока шла загрузка, контекст мог появиться из параллельного запроса
+        context = self.cache.get(user_id)
+        if context is not None:
+            self._touch(user_id, context)
+            return context
+
+        if loaded is None:
+            if not create:
+                return None
+            loaded = init_user_context()
+            self._dirty[user_id] = loaded
+            admin_stats.user_created(loaded)
+
+        self._touch(user_id, loaded)
+        return loaded
+
+    def mark_dirty(self, user_id: int, context: UserContext):
+        self._dirty[user_id] = context
+
+    async def set_banned(self, user_id: int, banned: bool) -> bool:
+        """Меняет флаг блокировки и сразу сохраняет его. False - пользователь не найден"""
+        context = await self.get(user_id, create=False)
+        if context is None:
+            return False
+
+        if context.banned != banned:
+            admin_stats.ban_changed(banned)
+        context.banned = banned
+        self._dirty.pop(user_id, None)
+        await self.store.upsert({user_id: context}, with_banned=True)
+        return True
+
+    async def mark_blocked(self, user_id: int):
+        """Отмечает, что пользователь заблокировал бота; рассылки будут его пропускать"""
+        context = await self.get(user_id, create=False)
+        if context is None or context.blocked:
+            return
+        context.blocked = True
+        self._dirty.pop(user_id, None)
+        await self.store.upsert({user_id: context})
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            items = list(dirty.items())
+            for i in range(0, len(items), self.batch_size):
+                batch = dict(items[i:i + self.batch_size])
+                try:
+                    await self.store.upsert(batch)
+                except Exception as e:
+                    logger.error(f"Failed to flush {len(batch)} user contexts: {e}")
+                    for user_id, context in items[i:]:
+                        self._dirty.setdefault(user_id, context)
+                    return
+            logger.debug(f"Flushed {len(items)} user contexts")
+
+    def evict_idle(self):
+        """Выгружает из горячего кэша давно неактивных пользователей и лишние записи сверх лимита.
+
+        Несохраненные контексты остаются в кэше до следующей записи.
+        """
+        cutoff = time.monotonic() - self.idle_ttl
+        evict = []
+        overflow = len(self.cache) - self.max_cached
+        for user_id, context in self.cache.items():
+            if context.touched > cutoff and len(evict) >= overflow:
+                break
+            if user_id not in self._dirty:
+                evict.append(user_id)
+        for user_id in evict:
+            del self.cache[user_id]
+        if evict:
+            self.evicted += len(evict)
+            logger.debug(f"Evicted {len(evict)} idle user contexts, {len(self.cache)} cached")
+
+    async def sync_shared(self):
+        """Обновляет закэшированные контексты, сохраненные другими процессами.
+
+        Объект контекста не заменяется, а обновляется на месте - обработчики, которые
+        держат на него ссылку, продолжат работать с ним. У контекстов с несохраненными
+        изменениями обновляется только бан: остальное при записи перезапишет этот
+        процесс (побеждает последний писатель).
+        """
+        started = int(time.time() * 1000)
+        try:
+            changed = await self.store.changed_since(self._synced_at - self.SYNC_OVERLAP_MS)
+        except Exception as e:
+            logger.error(f"Failed to sync user contexts: {e}")
+            return
+        self._synced_at = started
+        refreshed = 0
+        for user_id in changed:
+            context = self.cache.get(user_id)
+            if context is None:
+                continue
+            loaded = await self.store.load(user_id)
+            if loaded is None:
+                continue
+            if user_id in self._dirty:
+                context.banned = loaded.banned
+            else:
+                context.assign(loaded)
+            refreshed += 1
+        if refreshed:
+            logger.debug(f"Refreshed {refreshed} user contexts changed by other workers")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.shared:
+                await self.sync_shared()
+            self.evict_idle()
+
+    async def iter_users(self, chunk_size: int = 1000) -> AsyncIterator[List[tuple]]:
+        """Обход всех пользователей хранилища; несохраненные изменения сбрасываются заранее"""
+        await self.flush()
+        async for chunk in self.store.iter_users(chunk_size):
+            # Для пользователей из горячего кэша отдаем актуальный объект
+            yield [(user_id, self.cache.get(user_id, context)) for user_id, context in chunk]
+
+    async def stats(self) -> Dict[str, int]:
+        await self.flush()
+        return await self.store.stats()
+
+
+def create_user_store(url: str) -> UserStore:
+    """Выбирает реализацию хранилища по DATABASE_URL"""
+    if url == "memory://":
+        return MemoryUserStore()
+    # Heroku отдает адрес вида postgres://, SQLAlchemy нужен явный драйвер
+    if url.startswith("postgres://"):
+        url = "postgresql+asyncpg://" + url[len("postgres://"):]
+    elif url.startswith("postgresql://"):
+        url = "postgresql+asyncpg://" + url[len("postgresql://"):]
+    return SQLUserStore(url, writer=WORKER_ID)
+
+
+user_repo = UserRepository(
+    create_user_store(DATABASE_URL),
+    flush_interval=USER_FLUSH_INTERVAL,
+    batch_size=USER_FLUSH_BATCH_SIZE,
+    idle_ttl=USER_IDLE_TTL,
+    max_cached=USER_CACHE_MAX,
+    shared=WEB_WORKERS > 1
+)
+
+
+class StoreFSMStorage(BaseStorage):
+    """Состояния FSM (диалоги рассылки и поиска в админке) в хранилище пользователей.
+
+    Состояние переживает перезапуск и доступно любому процессу. Чтение идет из
+    локального кэша: апдейты одного чата всегда попадают в один и тот же процесс,
+    поэтому его ключи FSM больше никто не меняет. Запись сквозная.
+    """
+
+    def __init__(self, store: UserStore, max_cached: int = 10000):
+        self.store = store
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self.max_cached = max_cached
+        self._cache: OrderedDict = OrderedDict()  # ключ -> (state, data)
+
+    async def _load(self, key: StorageKey) -> tuple:
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            record = await self.store.get_fsm(storage_key) or (None, {})
+            self._remember(storage_key, record)
+        else:
+            self._cache.move_to_end(storage_key)
+        return record
+
+    def _remember(self, storage_key: str, record: tuple):
+        self._cache[storage_key] = record
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    async def _save(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        storage_key = self.key_builder.build(key)
+        await self.store.set_fsm(storage_key, state, data)
+        self._remember(storage_key, (state, data))
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        _, data = await self._load(key)
+        await self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._load(key)
+        await self._save(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return data.copy()
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+dp = Dispatcher(storage=StoreFSMStorage(user_repo.store))
+
+
+class AdminStats:
+    """Статистика админки, которая ведется по событиям, а не обходом всех пользователей.
+
+    Каждый пользователь учтен в почасовой корзине своей последней активности,
+    поэтому сумма корзин за окно - точное число уникальных активных пользователей
+    (DAU/WAU/MAU). Вызовы команд считаются по часам с момента запуска процесса.
+    """
+
+    BUCKET_SECONDS = 3600
+    ACTIVITY_HOURS = 30 * 24
+    COMMAND_HOURS = 24
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.total = 0
+        self.banned = 0
+        self.active_hours: Dict[int, int] = {}  # час -> пользователи с последней активностью в этот час
+        self.command_hours: Dict[int, Dict[str, int]] = {}  # час -> {обработчик: вызовы}
+        self._pruned_hour = 0
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def load(self):
+        """Начальные значения одним агрегирующим запросом при запуске"""
+        await self._fetch()
+        logger.info(f"Admin stats loaded: {self.total} users, {self.active_users(24 * 30)} active in 30 days")
+
+    async def _fetch(self):
+        user_stats = await user_repo.stats()
+        self.total, self.banned = user_stats["total"], user_stats["banned"]
+        since = int(time.time()) - self.ACTIVITY_HOURS * self.BUCKET_SECONDS
+        self.active_hours = await user_repo.store.activity_histogram(since, self.BUCKET_SECONDS)
+
+    async def start(self):
+        """При нескольких процессах каждый видит только свои события, поэтому счетчики
+        пользователей периодически перечитываются из хранилища в фоне, а не при каждом
+        показе админки. Вызовы команд остаются счетчиками своего процесса."""
+        await self.load()
+        if user_repo.shared:
+            self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self._fetch()
+            except Exception as e:
+                logger.error(f"Admin stats refresh failed: {e}")
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresher
+            self._refresher = None
+
+    def user_created(self, context: UserContext):
+        self.total += 1
+        self.record_activity(0, context.last_active)
+
+    def ban_changed(self, banned: bool):
+        self.banned += 1 if banned else -1
+
+    def record_activity(self, previous: int, now: int):
+        """Переносит пользователя из корзины прошлой активности в текущую"""
+        hour = now // self.BUCKET_SECONDS
+        previous_hour = previous // self.BUCKET_SECONDS if previous else None
+        if previous_hour == hour:
+            return
+        if previous_hour in self.active_hours:
+            self.active_hours[previous_hour] -= 1
+            if not self.active_hours[previous_hour]:
+                del self.active_hours[previous_hour]
+        self.active_hours[hour] = self.active_hours.get(hour, 0) + 1
+        self._prune(hour)
+
+    def record_command(self, name: str):
+        hour = int(time.time()) // self.BUCKET_SECONDS
+        counts = self.command_hours.setdefault(hour, {})
+        counts[name] = counts.get(name, 0) + 1
+        self._prune(hour)
+
+    def _prune(self, hour: int):
+        """Удаляет корзины, вышедшие из окна; выполняется раз в час"""
+        if hour == self._pruned_hour:
+            return
+        self._pruned_hour = hour
+        for key in [key for key in self.active_hours if key <= hour - self.ACTIVITY_HOURS]:
+            del self.active_hours[key]
+        for key in [key for key in self.command_hours if key <= hour - self.COMMAND_HOURS]:
+            del self.command_hours[key]
+
+    def active_users(self, hours: int) -> int:
+        oldest = int(time.time()) // self.BUCKET_SECONDS - hours
+        return sum(count for hour, count in self.active_hours.items() if hour > oldest)
+
+    def command_counts(self) -> List[tuple]:
+        oldest = int(time.time()) // self.BUCKET_SECONDS - self.COMMAND_HOURS
+        totals: Dict[str, int] = {}
+        for hour, counts in self.command_hours.items():
+            if hour > oldest:
+                for name, count in counts.items():
+                    totals[name] = totals.get(name, 0) + count
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+    def render(self) -> str:
+        commands = ", ".join(f"{name}: {count}" for name, count in self.command_counts()[:8])
+        return (
+            f"📊 <b>Статистика системы:</b>\n"
+            f"👥 Всего пользователей: {self.total}\n"
+            f"💬 Активных: за сутки {self.active_users(24)}, за 7 дней {self.active_users(24 * 7)}, "
+            f"за 30 дней {self.active_users(24 * 30)}\n"
+            f"🚫 Заблокированных: {self.banned}\n"
+            f"⌨️ Команды за 24 ч: {commands or 'нет'}\n"
+            f"🗃 Кэш ответов: {response_cache.stats()}\n"
+            f"🧵 Очередь оракула: {llm_scheduler.stats()}\n"
+            f"📥 Апдейты: {update_dispatcher.stats()}\n"
+            f"📮 Задания: {llm_jobs.stats()}\n"
+            f"🛡 API: {llm_router.stats()}\n"
+            f"🎴 Пул ответов: {response_pool.stats()}"
+        )
+
+
+admin_stats = AdminStats(refresh_interval=ADMIN_STATS_REFRESH_INTERVAL)
+
+
+# Рассылки
+class TokenBucket:
+    """Ограничитель скорости token bucket: не более rate операций в секунду"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу маркеров (ответ Telegram retry_after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BroadcastEngine:
+    """Фоновые рассылки с общим лимитом скорости, пулом отправителей и чекпоинтами.
+
+    Обработанные получатели периодически сохраняются в хранилище, поэтому после
+    перезапуска рассылка продолжается с места остановки.
+    """
+
+    def __init__(self, rate: float, workers: int, checkpoint_size: int):
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.workers = workers
+        self.checkpoint_size = checkpoint_size
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self):
+        """Возобновляет незавершенные рассылки"""
+        for job in await user_repo.store.unfinished_broadcasts():
+            logger.info(f"Resuming broadcast #{job['id']}")
+            self._launch(job)
+
+    async def stop(self):
+        """Останавливает рассылки; их прогресс уже сохранен и продолжится после старта"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def submit(self, text: str, admin_chat_id: int) -> int:
+        broadcast_id = await user_repo.store.create_broadcast(text, admin_chat_id)
+        progress = await bot.send_message(admin_chat_id, f"📤 Рассылка #{broadcast_id} запущена...")
+        await user_repo.store.update_broadcast(broadcast_id, progress_message_id=progress.message_id)
+        self._launch({
+            "id": broadcast_id, "text": text, "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress.message_id, "sent": 0, "failed": 0, "blocked": 0
+        })
+        return broadcast_id
+
+    def _launch(self, job: Dict[str, Any]):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+
+    async def _run(self, job: Dict[str, Any]):
+        broadcast_id = job["id"]
+        counters = {"sent": job["sent"], "failed": job["failed"], "blocked": job["blocked"]}
+        processed = await user_repo.store.processed_recipients(broadcast_id)
+        total = admin_stats.total
+        pending_results: List[tuple] = []
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 4)
+        done = asyncio.Event()
+
+        async def checkpoint():
+            results = pending_results[:]
+            pending_results.clear()
+            await user_repo.store.record_recipients(broadcast_id, results)
+            await user_repo.store.update_broadcast(broadcast_id, **counters)
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                if user_id is None:
+                    return
+                status = await self._deliver(user_id, job["text"])
+                counters[status] += 1
+                pending_results.append((user_id, status))
+                if len(pending_results) >= self.checkpoint_size:
+                    await checkpoint()
+
+        async def report_progress():
+            while not done.is_set():
+                await self._show_progress(job, counters, total)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(done.wait(), timeout=BROADCAST_PROGRESS_INTERVAL)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        reporter = asyncio.create_task(report_progress())
+        try:
+            async for chunk in user_repo.iter_users():
+                for user_id, context in chunk:
+                    if user_id in processed or context.blocked:
+                        continue
+                    await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            done.set()
+            await asyncio.gather(reporter, return_exceptions=True)
+            await checkpoint()
+
+        await user_repo.store.update_broadcast(broadcast_id, status="done")
+        await self._show_progress(job, counters, total, finished=True)
+        logger.info(f"Broadcast #{broadcast_id} finished: {counters}")
+
+    async def _deliver(self, user_id: int, text: str) -> str:
+        for _ in range(3):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(user_id, f"📢 Рассылка:\n\n{text}")
+                return "sent"
+            except TelegramRetryAfter as e:
+                logger.warning(f"Broadcast flood control, pausing {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                await user_repo.mark_blocked(user_id)
+                return "blocked"
+            except Exception as e:
+                logger.warning(f"Broadcast failed to send to {user_id}: {e}",
+                               extra={"user_id": user_id})
+                return "failed"
+        return "failed"
+
+    async def _show_progress(self, job: Dict[str, Any], counters: Dict[str, int], total: int,
+                             finished: bool = False):
+        title = "✅ Рассылка завершена" if finished else "📤 Идет рассылка"
+        text = (
+            f"{title} #{job['id']}:\n"
+            f"• Успешно: {counters['sent']}\n"
+            f"• Не удалось: {counters['failed']}\n"
+            f"• Заблокировали бота: {counters['blocked']}\n"
+            f"• Обработано: {sum(counters.values())} из ~{total}"
+        )
+        try:
+            await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["progress_message_id"])
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning(f"Failed to update broadcast progress: {e}")
+
+
+broadcast_engine = BroadcastEngine(
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+    checkpoint_size=BROADCAST_CHECKPOINT_SIZE
+)
+
+
+# Профили пользователей и поиск
+class ProfileIndex:
+    """Локальный индекс профилей (имя, фамилия, username) для поиска без get_chat.
+
+    Профили берутся из входящих сообщений, для поиска по префиксу слова
+    используется отсортированный список токенов. Фрагмент ID ищется в любой
+    позиции по индексу цифровых триграмм, в который попадают и пользователи
+    без профиля. Отсутствующие и устаревшие профили обновляются в фоне с
+    ограниченной параллельностью.
+    """
+
+    def __init__(self, ttl: float, refresh_concurrency: int, refresh_rate: float):
+        self.ttl = ttl
+        self.refresh_concurrency = refresh_concurrency
+        self.profiles: Dict[int, tuple] = {}  # user_id -> (first_name, last_name, username, updated_at)
+        self._tokens: List[tuple] = []  # отсортированные (токен, user_id)
+        self._ids: set = set()
+        self._id_grams: Dict[str, array] = {}  # триграмма цифр -> user_id, в ID которых она встречается
+        self._short_ids: List[int] = []  # отсортированные ID короче триграммы
+        self._dirty: set = set()
+        self._refresh_queue: asyncio.Queue = asyncio.Queue()
+        self._queued: set = set()
+        self._refresh_bucket = TokenBucket(refresh_rate, capacity=refresh_rate)
+        self._tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def _profile_tokens(profile: tuple) -> set:
+        """Слова имени и username; ID ищется по отдельному индексу"""
+        tokens = set()
+        for field in profile[:3]:
+            tokens.update(field.lower().replace("ё", "е").split())
+        return tokens
+
+    def _index(self, user_id: int, profile: tuple):
+        old = self.profiles.get(user_id)
+        old_tokens = self._profile_tokens(old) if old else set()
+        new_tokens = self._profile_tokens(profile)
+        for token in old_tokens - new_tokens:
+            position = bisect.bisect_left(self._tokens, (token, user_id))
+            if position < len(self._tokens) and self._tokens[position] == (token, user_id):
+                del self._tokens[position]
+        for token in new_tokens - old_tokens:
+            bisect.insort(self._tokens, (token, user_id))
+        self.profiles[user_id] = profile
+        self._index_id(user_id)
+
+    def _index_id(self, user_id: int):
+        if user_id in self._ids:
+            return
+        self._ids.add(user_id)
+        digits = str(user_id)
+        if len(digits) < 3:
+            bisect.insort(self._short_ids, user_id)
+        for gram in {digits[i:i + 3] for i in range(len(digits) - 2)}:
+            postings = self._id_grams.get(gram)
+            if postings is None:
+                postings = self._id_grams[gram] = array("q")
+            # Новые ID обычно больше прежних - вставка в конец
+            bisect.insort(postings, user_id)
+
+    def observe(self, user_id: int, first_name: str, last_name: Optional[str], username: Optional[str]):
+        """Запоминает профиль из входящего апдейта; запись в хранилище откладывается"""
+        fields = (first_name or "", last_name or "", username or "")
+        current = self.profiles.get(user_id)
+        if current is not None and current[:3] == fields and time.time() - current[3] < self.ttl / 2:
+            return
+        self._index(user_id, fields + (int(time.time()),))
+        self._dirty.add(user_id)
+
+    def _prefix_range(self, prefix: str) -> tuple:
+        """Границы токенов с префиксом prefix в отсортированном списке"""
+        return (bisect.bisect_left(self._tokens, (prefix,)),
+                bisect.bisect_left(self._tokens, (prefix + "\uffff",)))
+
+    def _id_postings(self, fragment: str) -> List[Any]:
+        """Отсортированные списки ID, среди которых есть все ID с фрагментом: для
+        фрагмента от трех цифр - самый короткий из списков его триграмм, для
+        короткого - все триграммы, где он встречается"""
+        if len(fragment) >= 3:
+            grams = [self._id_grams.get(fragment[i:i + 3], ()) for i in range(len(fragment) - 2)]
+            return [min(grams, key=len)]
+        return [self._short_ids] + [postings for gram, postings in self._id_grams.items() if fragment in gram]
+
+    def _estimate(self, word: str) -> int:
+        """Верхняя оценка числа совпадений слова без перебора"""
+        start, end = self._prefix_range(word)
+        if word.isdigit():
+            return end - start + sum(len(postings) for postings in self._id_postings(word))
+        return end - start
+
+    def _candidates(self, word: str) -> Iterator[int]:
+        """Пользователи, у которых слово - префикс токена или часть ID, по возрастанию ID"""
+        start, end = self._prefix_range(word)
+        sources = []
+        # Внутри одного токена user_id уже отсортированы; если разных токенов много, остаток сортируется целиком
+        while start < end and len(sources) < 256:
+            token_end = bisect.bisect_left(self._tokens, (self._tokens[start][0] + "\0",), start, end)
+            sources.append(self._tokens[i][1] for i in range(start, token_end))
+            start = token_end
+        if start < end:
+            sources.append(sorted({user_id for _, user_id in self._tokens[start:end]}))
+        if word.isdigit():
+            sources += self._id_postings(word)
+        previous = None
+        for user_id in heapq.merge(*sources):
+            if user_id != previous:
+                previous = user_id
+                yield user_id
+
+    def _word_matches(self, word: str, user_id: int) -> bool:
+        if word.isdigit() and word in str(user_id):
+            return True
+        profile = self.profiles.get(user_id)
+        return profile is not None and any(
+            token.startswith(word) for token in self._profile_tokens(profile))
+
+    def search(self, query: str, limit: int = 5) -> List[int]:
+        """Пользователи, у которых каждое слово запроса - префикс имени или username либо часть ID.
+
+        Кандидаты по самому редкому слову перебираются по возрастанию ID и
+        проверяются остальными словами, пока не наберется limit совпадений.
+        """
+        words = query.lower().replace("ё", "е").lstrip("@").split()
+        if not words:
+            return []
+
+        words.sort(key=self._estimate)
+        found = (user_id for user_id in self._candidates(words[0])
+                 if all(self._word_matches(word, user_id) for word in words))
+        user_ids = list(itertools.islice(found, limit))
+        for user_id in user_ids:
+            profile = self.profiles.get(user_id)
+            if profile is not None and time.time() - profile[3] > self.ttl:
+                self.schedule_refresh(user_id)
+        return user_ids
+
+    def schedule_refresh(self, user_id: int):
+        if user_id not in self._queued:
+            self._queued.add(user_id)
+            self._refresh_queue.put_nowait(user_id)
+
+    async def start(self, enqueue_missing: bool = True):
+        """Загружает профили из хранилища и ставит в очередь пользователей без профиля"""
+        async for chunk in user_repo.store.iter_profiles():
+            for user_id, profile in chunk:
+                self.profiles[user_id] = profile
+        # Сортировка один раз вместо вставки каждого токена
+        self._tokens = sorted(
+            (token, user_id)
+            for user_id, profile in self.profiles.items()
+            for token in self._profile_tokens(profile)
+        )
+        # ID пользователей без профиля тоже ищутся по фрагменту; по возрастанию - чтобы вставки шли в конец
+        user_ids = set(self.profiles)
+        async for chunk in user_repo.store.iter_export_rows():
+            user_ids.update(user_id for user_id, *_ in chunk)
+        for user_id in sorted(user_ids):
+            self._index_id(user_id)
+        logger.info(f"Profile index loaded: {len(self.profiles)} profiles, {len(self._ids)} user IDs")
+
+        self._tasks = [asyncio.create_task(self._refresh_worker()) for _ in range(self.refresh_concurrency)]
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+        if enqueue_missing:
+            self._tasks.append(asyncio.create_task(self._enqueue_missing()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        rows = {user_id: self.profiles[user_id] for user_id in dirty}
+        try:
+            await user_repo.store.upsert_profiles(rows)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(rows)} profiles: {e}")
+            self._dirty.update(dirty)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USER_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def _enqueue_missing(self):
+        async for chunk in user_repo.iter_users():
+            for user_id, _ in chunk:
+                if user_id not in self.profiles:
+                    self.schedule_refresh(user_id)
+
+    async def _refresh_worker(self):
+        while True:
+            user_id = await self._refresh_queue.get()
+            try:
+                await self._refresh_bucket.acquire()
+                chat = await bot.get_chat(user_id)
+                self._index(user_id, (chat.first_name or "", chat.last_name or "", chat.username or "",
+                                      int(time.time())))
+            except TelegramRetryAfter as e:
+                self._refresh_bucket.pause(e.retry_after)
+                self._queued.discard(user_id)
+                self.schedule_refresh(user_id)
+                continue
+            except Exception as e:
+                # Удаленный аккаунт или недоступный чат: запоминаем, чтобы не запрашивать снова до истечения TTL
+                logger.debug(f"Profile refresh failed for {user_id}: {e}")
+                current = self.profiles.get(user_id, ("", "", ""))
+                self._index(user_id, current[:3] + (int(time.time()),))
+            self._dirty.add(user_id)
+            self._queued.discard(user_id)
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Привязывает записи лога, сделанные при обработке апдейта, к его отправителю"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        current_user_id.set(user.id if user else None)
+        return await handler(event, data)
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Обновляет индекс профилей по отправителю каждого сообщения и нажатия кнопки"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and not user.is_bot:
+            profile_index.observe(user.id, user.first_name, user.last_name, user.username)
+        return await handler(event, data)
+
+
+profile_index = ProfileIndex(
+    ttl=PROFILE_TTL,
+    refresh_concurrency=PROFILE_REFRESH_CONCURRENCY,
+    refresh_rate=PROFILE_REFRESH_RATE
+)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на пользователя и на групповой чат отдельно для команд оракула и
+    для меню/кнопок. Лишние апдейты отклоняются до обработчика: без статуса
+    «печатает», запроса к LLM и изменения истории.
+
+    Корзины - пары [маркеры, время] в одном словаре по ключу (id, класс): ID
+    пользователей положительные, групп - отрицательные. Полностью восстановленные
+    корзины периодически удаляются.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.limits = {
+            ("user", "llm"): (THROTTLE_USER_LLM_PER_MINUTE / 60, THROTTLE_LLM_BURST),
+            ("user", "menu"): (THROTTLE_USER_MENU_PER_MINUTE / 60, THROTTLE_MENU_BURST),
+            ("chat", "llm"): (THROTTLE_CHAT_LLM_PER_MINUTE / 60, THROTTLE_LLM_BURST),
+            ("chat", "menu"): (THROTTLE_CHAT_MENU_PER_MINUTE / 60, THROTTLE_MENU_BURST),
+        }
+        self._buckets: Dict[tuple, list] = {}
+        self._notified: Dict[int, float] = {}  # user_id -> до какого времени не предупреждать повторно
+        self._swept_at = time.monotonic()
+
+    @staticmethod
+    def command_class(event) -> str:
+        if isinstance(event, Message) and event.text and event.text.startswith("/"):
+            command = event.text.split(maxsplit=1)[0][1:].split("@")[0].lower()
+            if command in LLM_COMMANDS:
+                return "llm"
+        return "menu"
+
+    def _take(self, key: tuple, rate: float, capacity: float, now: float) -> float:
+        """Забирает маркер; возвращает 0 или сколько секунд ждать следующего"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [capacity - 1, now]
+            return 0.0
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+    def _sweep(self, now: float):
+        self._swept_at = now
+        full = []
+        for key, (tokens, updated) in self._buckets.items():
+            rate, capacity = self.limits["user" if key[0] > 0 else "chat", key[1]]
+            if tokens + (now - updated) * rate >= capacity:
+                full.append(key)
+        for key in full:
+            del self._buckets[key]
+        self._notified = {user_id: until for user_id, until in self._notified.items() if until > now}
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self._swept_at > self.SWEEP_INTERVAL:
+            self._sweep(now)
+
+        command_class = self.command_class(event)
+        wait = self._take((user.id, command_class), *self.limits["user", command_class], now)
+        scope = "user"
+        if not wait and chat is not None and chat.id != user.id:
+            wait = self._take((-abs(chat.id), command_class), *self.limits["chat", command_class], now)
+            scope = "chat"
+        if wait:
+            throttled_updates.inc(scope=scope, command_class=command_class)
+            await self._reject(event, user.id, wait, now)
+            return None
+
+        if command_class == "llm":
+            context = await user_repo.get(user.id, create=False)
+            if context is not None and context.banned:
+                await event.answer("🚫 Ваш доступ к оракулу ограничен")
+                return None
+
+        return await handler(event, data)
+
+    async def _reject(self, event, user_id: int, wait: float, now: float):
+        text = f"⏳ Слишком много запросов. Попробуйте через {max(1, round(wait))} с."
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            elif self._notified.get(user_id, 0) < now:
+                # Одно предупреждение на период ожидания, чтобы не отвечать на каждое сообщение
+                self._notified[user_id] = now + wait
+                await event.answer(text)
+        except TelegramAPIError as e:
+            logger.debug(f"Throttling notice failed for {user_id}: {e}")
+
+
+dp.update.outer_middleware(LogContextMiddleware())
+throttling = ThrottlingMiddleware()
+router.message.outer_middleware(throttling)
+router.callback_query.outer_middleware(throttling)
+router.message.outer_middleware(ProfileMiddleware())
+router.callback_query.outer_middleware(ProfileMiddleware())
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для одного API.
+
+    После failure_threshold ошибок подряд (таймауты, 5xx, обрывы соединения)
+    размыкается: запросы к API не отправляются, пока фоновая проба не пройдет.
+    """
+
+    def __init__(self, name: str, failure_threshold: int):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку; True - размыкатель только что разомкнулся"""
+        self.failures += 1
+        if self.is_open or self.failures < self.failure_threshold:
+            return False
+        self.opened_at = time.monotonic()
+        upstream_breaker_open.set(1, upstream=self.name)
+        logger.error(f"Upstream {self.name} circuit opened after {self.failures} consecutive failures")
+        return True
+
+    def close(self):
+        if self.is_open:
+            logger.info(f"Upstream {self.name} circuit closed after {time.monotonic() - self.opened_at:.0f}s")
+        self.failures = 0
+        self.opened_at = None
+        upstream_breaker_open.set(0, upstream=self.name)
+
+
+class Upstream:
+    """Адрес LLM API со своим ключом, моделью и размыкателем"""
+
+    def __init__(self, name: str, url: str, api_key: str, model: str):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.breaker = CircuitBreaker(name, LLM_BREAKER_FAILURES)
+
+    def payload(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return {**data, "model": self.model}
+
+
+primary_upstream = Upstream("primary", API_URL, API_KEY, LLM_MODEL)
+fallback_upstream = (Upstream("fallback", FALLBACK_API_URL, FALLBACK_API_KEY, FALLBACK_MODEL)
+                     if FALLBACK_API_URL else None)
+upstreams = [u for u in (primary_upstream, fallback_upstream) if u is not None]
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Ошибки, которые говорят о проблемах API, а не запроса: таймаут, 5xx, сбой соединения"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError))
+
+
+class APIClient:
+    """Общий клиент LLM API с пулом соединений и keep-alive"""
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        # Общего таймаута нет: дедлайн каждого запроса задает LLMRouter
+        self.timeout = ClientTimeout(total=None, connect=10, sock_connect=10)
+        self.headers = {"Content-Type": "application/json"}
+
+    def _create_connector(self) -> aiohttp.TCPConnector:
+        """Коннектор с ограниченным пулом, keep-alive и кэшем DNS"""
+        return aiohttp.TCPConnector(
+            limit=LLM_POOL_LIMIT,
+            limit_per_host=LLM_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=LLM_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=LLM_DNS_CACHE_TTL,
+            enable_cleanup_closed=True
+        )
+
+    async def start(self):
+        """Открывает сессию и прогревает соединения с API"""
+        await self.ensure_session()
+        await self.warm_up()
+
+    async def warm_up(self):
+        """Заранее устанавливает TCP+TLS соединения, чтобы первый запрос не платил за рукопожатие"""
+        session = await self.ensure_session()
+
+        async def _probe(upstream: Upstream):
+            try:
+                async with session.head(upstream.url, headers=upstream.headers,
+                                        timeout=ClientTimeout(total=10)) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"LLM warm-up probe to {upstream.name} failed: {e}")
+
+        await asyncio.gather(*(_probe(upstream) for upstream in upstreams for _ in range(LLM_WARMUP_CONNECTIONS)))
+        logger.info(f"LLM connection pool warmed up ({LLM_WARMUP_CONNECTIONS} connections per upstream)")
+
+    async def ensure_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=self._create_connector(),
+                timeout=self.timeout,
+                headers=self.headers
+            )
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def _observe(self, upstream: Upstream, command: str, mode: str):
+        """Метрики запроса: время, статус ответа, число запросов в полете"""
+        outcome = {"status": "error"}
+        started = time.perf_counter()
+        upstream_in_flight.inc()
+        try:
+            yield outcome
+        except asyncio.TimeoutError:
+            outcome["status"] = "timeout"
+            raise
+        except aiohttp.ClientResponseError as e:
+            outcome["status"] = str(e.status)
+            raise
+        finally:
+            upstream_in_flight.dec()
+            upstream_seconds.observe(time.perf_counter() - started, upstream=upstream.name,
+                                     command=command, mode=mode, status=outcome["status"])
+
+    async def make_request(self, data: Dict[str, Any], upstream: Upstream = primary_upstream,
+                           command: str = "probe") -> Dict[str, Any]:
+        session = await self.ensure_session()
+
+        try:
+            async with self._observe(upstream, command, "full") as outcome:
+                async with session.post(upstream.url, json=upstream.payload(data),
+                                        headers=upstream.headers) as response:
+                    response.raise_for_status()
+                    result = await response.json()
+                    outcome["status"] = str(response.status)
+            record_usage(result.get("usage"))
+            return result
+        except aiohttp.ClientResponseError as e:
+            if e.status == 401:
+                logger.error("Unauthorized: Check your API_KEY")
+            raise
+
+    async def stream_request(self, data: Dict[str, Any], upstream: Upstream = primary_upstream,
+                             command: str = "probe") -> AsyncIterator[str]:
+        """Запрос с stream=True: отдает фрагменты текста по мере прихода SSE-событий"""
+        session = await self.ensure_session()
+
+        payload_data = {**upstream.payload(data), "stream": True, "stream_options": {"include_usage": True}}
+        try:
+            async with self._observe(upstream, command, "stream") as outcome, \
+                    session.post(upstream.url, json=payload_data, headers=upstream.headers) as response:
+                response.raise_for_status()
+                outcome["status"] = str(response.status)
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8", errors="ignore").strip()
+                    if not line.startswith("data:"):
+                        continue
+
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+
+                    try:
+                        event = json.loads(payload)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Malformed SSE chunk skipped: {payload[:100]}")
+                        continue
+
+                    record_usage(event.get("usage"))
+                    choices = event.get("choices") or []
+                    if choices:
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            yield delta
+        except aiohttp.ClientResponseError as e:
+            if e.status == 401:
+                logger.error("Unauthorized: Check your API_KEY")
+            raise
+
+    async def close(self):
+        """Закрывает сессию и дожидается освобождения сокетов"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+            # Даем коннектору время корректно закрыть TLS-соединения
+            await asyncio.sleep(0.25)
+        self.session = None
+
+
+# Единый клиент на весь процесс
+api_client = APIClient()
+
+
+class TypingPresence:
+    """Статус «печатает» с подсчетом ссылок: одна задача на чат, сколько бы
+    запросов в нем ни выполнялось, и не чаще одного send_chat_action за interval."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._refs: Dict[int, int] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._last_sent: Dict[int, float] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_id: int):
+        self._acquire(chat_id)
+        try:
+            yield
+        finally:
+            self._release(chat_id)
+
+    def _acquire(self, chat_id: int):
+        self._refs[chat_id] = self._refs.get(chat_id, 0) + 1
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._run(chat_id))
+
+    def _release(self, chat_id: int):
+        self._refs[chat_id] -= 1
+        if self._refs[chat_id] > 0:
+            return
+        del self._refs[chat_id]
+        task = self._tasks.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+        if len(self._last_sent) > 10000:
+            cutoff = time.monotonic() - self.interval
+            self._last_sent = {c: t for c, t in self._last_sent.items() if t > cutoff}
+
+    async def _run(self, chat_id: int):
+        logger.debug(f"Starting typing status for chat_id: {chat_id}")
+        try:
+            # Статус от предыдущего запроса еще виден - не отправляем повторно раньше срока
+            delay = self._last_sent.get(chat_id, 0) + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while True:
+                try:
+                    self._last_sent[chat_id] = time.monotonic()
+                    await bot.send_chat_action(chat_id, "typing")
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except (TelegramBadRequest, TelegramForbiddenError) as e:
+                    logger.debug(f"Typing status unavailable for chat_id {chat_id}: {e}")
+                    return
+                except Exception as e:
+                    logger.error(f"Error in typing status: {e}")
+                await asyncio.sleep(self.interval)
+        finally:
+            logger.debug(f"Stopping typing status for chat_id: {chat_id}")
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._tasks)
+
+
+typing_presence = TypingPresence(interval=TYPING_INTERVAL)
+
+
+def message_cost(text: str) -> int:
+    """Длина текста в HTML-сообщении: после экранирования, в единицах UTF-16, как считает Telegram"""
+    escaped = html.escape(text, quote=False)
+    return len(escaped) + sum(1 for char in escaped if ord(char) > 0xFFFF)
+
+
+ESCAPED_COST = {"<": 4, ">": 4, "&": 5}  # &lt; &gt; &amp;
+
+
+def clip_text(text: str, limit: int) -> str:
+    """Самый длинный префикс текста, укладывающийся в limit"""
+    total = 0
+    for i, char in enumerate(text):
+        total += ESCAPED_COST.get(char, 2 if char > "\uffff" else 1)
+        if total > limit:
+            return text[:i]
+    return text
+
+
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def split_fragments(text: str, limit: int, separators: tuple = SPLIT_SEPARATORS) -> List[str]:
+    """Режет текст на куски не длиннее limit: по абзацам, затем по строкам,
+    предложениям и словам; разделитель остается в конце куска"""
+    if message_cost(text) <= limit:
+        return [text]
+    if not separators:
+        fragments = []
+        while text:
+            fragment = clip_text(text, limit)
+            fragments.append(fragment)
+            text = text[len(fragment):]
+        return fragments
+    separator, rest = separators[0], separators[1:]
+    parts = text.split(separator)
+    fragments = []
+    for i, part in enumerate(parts):
+        fragments.extend(split_fragments(part + separator if i < len(parts) - 1 else part, limit, rest))
+    return fragments
+
+
+def split_message(text: str, prefix: str = "", limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на сообщения не длиннее limit с prefix в начале первого.
+
+    Текст режется до экранирования, поэтому сущность HTML никогда не попадает на
+    границу частей; длина считается уже экранированной.
+    """
+    budget = limit - message_cost(prefix)
+    messages: List[str] = []
+    current, size = prefix, message_cost(prefix)
+    for fragment in split_fragments(text, budget):
+        cost = message_cost(fragment)
+        if size + cost > limit:
+            if current.strip():
+                messages.append(current.rstrip())
+            fragment = fragment.lstrip()
+            current, size = "", 0
+            cost = message_cost(fragment)
+        current += fragment
+        size += cost
+    if current.strip() or not messages:
+        messages.append(current.rstrip())
+    return messages
+
+
+class StreamingReply:
+    """Ответ на сообщение reply_to в чате chat_id; адресуется только идентификаторами,
+    поэтому его можно продолжить после перезапуска.
+
+    С заглушкой (message_id) ответ дописывается в нее по мере генерации: правки
+    отправляются пачками не чаще интервала, допустимого лимитами Telegram.
+
+    Заголовок и ответ - простой текст: при доставке он экранируется один раз и
+    делится по абзацам на сообщения в пределах MESSAGE_LIMIT. Первая часть
+    заменяет заглушку, остальные уходят следом с паузой по лимиту чата; parts_sent -
+    сколько продолжений уже доставлено, повторная доставка их пропускает.
+    """
+
+    PLACEHOLDER = "⏳ Оракул всматривается в поток..."
+    CURSOR = " ▌"
+    MAX_HEADER = MESSAGE_LIMIT // 4
+
+    def __init__(self, chat_id: int, reply_to: int, header: str, private: bool = True,
+                 message_id: Optional[int] = None, parts_sent: int = 0):
+        if message_cost(header) > self.MAX_HEADER:
+            # Заголовок с аргументом команды: длинный вопрос не должен вытеснять ответ
+            header = clip_text(header, self.MAX_HEADER - 4).rstrip() + "…\n\n"
+        self.chat_id = chat_id
+        self.reply_to = reply_to
+        self.header = header
+        self.message_id = message_id
+        self.parts_sent = parts_sent
+        self.interval = STREAM_EDIT_INTERVAL if private else STREAM_GROUP_EDIT_INTERVAL
+        self.send_interval = SEND_INTERVAL if private else SEND_GROUP_INTERVAL
+        self._next_edit_at = 0.0
+        self._next_send_at = 0.0
+        self._shown_len = 0
+        self._last_body = ""
+
+    async def _send(self, text: str, parse_mode: Optional[str] = ParseMode.HTML) -> int:
+        await self._pace()
+        sent = await bot.send_message(
+            self.chat_id, text, parse_mode=parse_mode,
+            reply_parameters=ReplyParameters(message_id=self.reply_to, allow_sending_without_reply=True)
+        )
+        return sent.message_id
+
+    async def _pace(self):
+        """Не чаще одного сообщения за send_interval в этот чат"""
+        loop = asyncio.get_running_loop()
+        delay = self._next_send_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._next_send_at = loop.time() + self.send_interval
+
+    async def start(self):
+        """Отправляет заглушку"""
+        self.message_id = await self._send(f"{self.header}{self.PLACEHOLDER}", parse_mode=None)
+        self._next_edit_at = asyncio.get_running_loop().time() + self.interval
+
+    async def update(self, text: str):
+        """Промежуточная правка: пропускается, если еще рано или текста добавилось мало"""
+        if self.message_id is None:
+            return
+        if asyncio.get_running_loop().time() < self._next_edit_at:
+            return
+        if len(text) - self._shown_len < STREAM_MIN_CHARS:
+            return
+
+        # Промежуточные версии без разметки; показывается то, что войдет в первое сообщение
+        first = split_message(text, self.header, MESSAGE_LIMIT - len(self.CURSOR))[0]
+        await self._edit(first + self.CURSOR, parse_mode=None)
+        self._shown_len = len(text)
+
+    async def finish(self, text: str, on_progress: Optional[Callable[[], Awaitable[None]]] = None):
+        """Финальная версия ответа. Без заглушки первая часть отправляется новым
+        сообщением; иначе правка заглушки идет параллельно с отправкой продолжений -
+        они все равно окажутся после нее. on_progress вызывается после каждого
+        отправленного сообщения, чтобы сохранить message_id и parts_sent."""
+        first, *rest = split_message(text, self.header)
+        edit = None
+        if self.message_id is None:
+            self.message_id = await self._deliver(first, self._send)
+            if on_progress is not None:
+                await on_progress()
+        else:
+            edit = asyncio.create_task(self._deliver(first, self._edit_final))
+        try:
+            for part in rest[self.parts_sent:]:
+                await self._deliver(part, self._send)
+                self.parts_sent += 1
+                if on_progress is not None:
+                    await on_progress()
+        except BaseException:
+            if edit is not None:
+                edit.cancel()
+                await asyncio.gather(edit, return_exceptions=True)
+            raise
+        if edit is not None:
+            await edit
+
+    async def _deliver(self, part: str, send: Callable[[str, Optional[str]], Awaitable[Any]]) -> Any:
+        """Отправляет часть в HTML; если Telegram не принял разметку - той же частью
+        простым текстом, чтобы не потерять уже полученный ответ. На 429 ждет и повторяет."""
+        body, parse_mode = html.escape(part, quote=False), ParseMode.HTML
+        retries = 0
+        while True:
+            try:
+                return await send(body, parse_mode)
+            except TelegramRetryAfter as e:
+                retries += 1
+                if retries > 3:
+                    raise
+                logger.warning(f"Rate limit hit in chat {self.chat_id}, pausing {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if parse_mode is None:
+                    raise
+                logger.warning(f"HTML delivery failed in chat {self.chat_id}, falling back to plain text: {e}")
+                body, parse_mode = part, None
+
+    async def _edit_final(self, body: str, parse_mode: Optional[str]):
+        await self._edit(body, parse_mode, final=True)
+
+    async def _edit(self, body: str, parse_mode: Optional[str], final: bool = False):
+        if body == self._last_body:
+            return
+
+        try:
+            await bot.edit_message_text(body, chat_id=self.chat_id, message_id=self.message_id,
+                                        parse_mode=parse_mode)
+            self._last_body = body
+        except TelegramRetryAfter as e:
+            if final:
+                raise
+            logger.warning(f"Edit rate limit hit in chat {self.chat_id}, pausing {e.retry_after}s")
+            self._next_edit_at = asyncio.get_running_loop().time() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            if final:
+                raise
+            logger.warning(f"Intermediate edit failed: {e}")
+
+        self._next_edit_at = asyncio.get_running_loop().time() + self.interval
+
+
+class OracleError(Exception):
+    """Ошибка запроса к оракулу; текст исключения показывается пользователю"""
+
+
+class OracleBusy(OracleError):
+    """Очередь запросов переполнена, запрос отклонен без обращения к API"""
+
+
+class OracleUnavailable(OracleError):
+    """Все API недоступны (размыкатели разомкнуты), запрос отклонен сразу"""
+
+
+class LLMScheduler:
+    """Единая точка допуска запросов к LLM.
+
+    Ограничивает общее число запросов в полете, обслуживает пользователей по
+    очереди (не больше одного запроса на пользователя одновременно), отклоняет
+    новые запросы при переполнении очереди и при ответе 429 включает общую
+    паузу вместо независимых ожиданий в каждом обработчике. Фоновые запросы
+    (сжатие истории) идут отдельной очередью с низшим приоритетом: не занимают
+    слот пользователя и получают не больше половины емкости.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.background_concurrency = max(1, concurrency // 2)
+        self._waiting: "OrderedDict[int, deque]" = OrderedDict()  # user_id -> ожидающие futures
+        self._background: deque = deque()  # ожидающие futures фоновых запросов
+        self._active_users: set = set()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.queued = 0
+        self.shed = 0
+        self.cooldown_until = 0.0
+        self.wait_times: deque = deque(maxlen=1000)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int):
+        """Ждет своей очереди и держит слот на время запроса"""
+        if self.queued >= self.max_queue:
+            self.shed += 1
+            logger.warning(f"LLM queue is full ({self.queued}), request from {user_id} shed")
+            raise OracleBusy("🔮 Оракул сейчас занят множеством вопросов. Попробуйте через минуту.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        enqueued_at = time.monotonic()
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменен - возвращаем его
+                self._release(user_id)
+            else:
+                self._forget(user_id, future)
+            raise
+
+        self.wait_times.append(time.monotonic() - enqueued_at)
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    @contextlib.asynccontextmanager
+    async def background_slot(self):
+        """Слот фонового запроса: выдается, когда нет ожидающих запросов пользователей"""
+        future = asyncio.get_running_loop().create_future()
+        self._background.append(future)
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release_background()
+            else:
+                self._background.remove(future)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release_background()
+
+    def _release_background(self):
+        self.background_in_flight -= 1
+        self.in_flight -= 1
+        self._dispatch()
+
+    def try_background_slot(self) -> bool:
+        """Слот для фоновой работы за счет свободной емкости. Не ждет: отказывает,
+        если кто-то в очереди, идет пауза после 429 или занято больше половины слотов."""
+        if self.queued or self.cooldown_until > time.monotonic() or self.in_flight >= self.concurrency // 2:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release_background_slot(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def report_rate_limited(self, retry_after: float):
+        """Ответ 429: приостанавливает выдачу слотов для всех на retry_after секунд"""
+        until = time.monotonic() + retry_after
+        if until > self.cooldown_until:
+            logger.warning(f"Upstream rate limit, LLM cooldown for {retry_after:.0f}s")
+            self.cooldown_until = until
+
+    def _forget(self, user_id: int, future: asyncio.Future):
+        waiters = self._waiting.get(user_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[user_id]
+
+    def _release(self, user_id: int):
+        self.in_flight -= 1
+        self._active_users.discard(user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        delay = self.cooldown_until - time.monotonic()
+        if delay > 0:
+            if self._wakeup is None:
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+            return
+
+        while self.in_flight < self.concurrency:
+            user_id = next((u for u in self._waiting if u not in self._active_users), None)
+            if user_id is None:
+                self._dispatch_background()
+                return
+
+            waiters = self._waiting[user_id]
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                # Остальные запросы пользователя - в конец круга
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+
+            self.in_flight += 1
+            self._active_users.add(user_id)
+            future.set_result(None)
+
+    def _dispatch_background(self):
+        while (self._background and self.in_flight < self.concurrency
+               and self.background_in_flight < self.background_concurrency):
+            self.in_flight += 1
+            self.background_in_flight += 1
+            self._background.popleft().set_result(None)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def stats(self) -> str:
+        waits = sorted(self.wait_times)
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0.0
+        cooldown = max(0.0, self.cooldown_until - time.monotonic())
+        return (f"в работе {self.in_flight}/{self.concurrency} (фоновых {self.background_in_flight}), "
+                f"в очереди {self.queued} (фоновых {len(self._background)}), "
+                f"ожидание p95 {p95:.1f}с, отклонено {self.shed}"
+                + (f", пауза {cooldown:.0f}с" if cooldown else ""))
+
+
+llm_scheduler = LLMScheduler(concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE)
+
+
+def retry_after_seconds(error: aiohttp.ClientResponseError, default: float) -> float:
+    """Значение заголовка Retry-After, если сервер его прислал"""
+    try:
+        return float(error.headers.get("Retry-After", default)) if error.headers else default
+    except ValueError:
+        return default
+
+
+class LatencyTracker:
+    """Скользящие окна задержек успешных запросов по команде и фазе:
+    "first" - до первого фрагмента ответа, "total" - весь ответ"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[tuple, deque] = {}
+
+    def record(self, command: str, phase: str, seconds: float):
+        self._samples.setdefault((command, phase), deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, command: str, phase: str) -> Optional[float]:
+        """None, пока замеров меньше min_samples"""
+        samples = self._samples.get((command, phase))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95)]
+
+
+class LLMRouter:
+    """Выбор API, дедлайны и дублирование запросов.
+
+    Дедлайн команды - p95 ее успешных ответов * LLM_DEADLINE_FACTOR в пределах
+    [LLM_DEADLINE_MIN, LLM_DEADLINE_MAX]; пока замеров мало - LLM_DEADLINE_MAX.
+    Если основной API не прислал первый фрагмент за свой p95 для команды, тот же
+    запрос уходит в резервный и побеждает первый ответивший; при ошибке основного
+    резервный вызывается сразу. API с разомкнутым размыкателем пропускается, пока
+    фоновая проба не пройдет.
+    """
+
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams = upstreams
+        self.latency = LatencyTracker()
+        self._probes: Dict[str, asyncio.Task] = {}
+
+    def deadline(self, command: str) -> float:
+        p95 = self.latency.p95(command, "total")
+        if p95 is None:
+            return LLM_DEADLINE_MAX
+        return min(LLM_DEADLINE_MAX, max(LLM_DEADLINE_MIN, p95 * LLM_DEADLINE_FACTOR))
+
+    def hedge_delay(self, command: str) -> float:
+        p95 = self.latency.p95(command, "first")
+        return p95 if p95 is not None else LLM_DEADLINE_MIN
+
+    async def complete(self, data: Dict[str, Any], command: str,
+                       on_partial: Optional[Callable[[str], Awaitable[None]]] = None, hedge: bool = True) -> str:
+        """Текст ответа; on_partial получает накопленный текст потокового ответа"""
+        started = time.monotonic()
+        deadline = started + self.deadline(command)
+        if on_partial is None:
+            response_data, upstream = await self._race(
+                command, deadline, hedge, lambda upstream: api_client.make_request(data, upstream, command))
+            if not isinstance(response_data.get("choices"), list) or not response_data["choices"]:
+                raise ValueError("Invalid API response structure")
+            content = response_data["choices"][0].get("message", {}).get("content", "")
+        else:
+            (first, stream), upstream = await self._race(
+                command, deadline, hedge, lambda upstream: self._open_stream(data, upstream, command))
+            content = await self._consume(stream, first, upstream, deadline, on_partial)
+        self.latency.record(command, "total", time.monotonic() - started)
+        return content
+
+    async def _race(self, command: str, deadline: float, hedge: bool,
+                    start: Callable[[Upstream], Awaitable[Any]]) -> tuple:
+        """Результат первого успешного API: (результат, upstream)"""
+        candidates = [upstream for upstream in self.upstreams if not upstream.breaker.is_open]
+        if not candidates:
+            raise OracleUnavailable("🌫 Оракул временно недоступен. Попробуйте через пару минут.")
+
+        backups = deque(candidates[1:])
+        launched: Dict[asyncio.Task, Upstream] = {}
+        pending: set = set()
+        winner: Optional[asyncio.Task] = None
+
+        def launch(upstream: Upstream):
+            task = asyncio.create_task(self._attempt(upstream, command, deadline, start))
+            launched[task] = upstream
+            pending.add(task)
+
+        launch(candidates[0])
+        hedge_at = time.monotonic() + self.hedge_delay(command)
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = max(0.0, hedge_at - time.monotonic()) if backups and hedge and LLM_HEDGE else None
+                done, pending_left = await asyncio.wait(pending, timeout=timeout,
+                                                        return_when=asyncio.FIRST_COMPLETED)
+                pending.intersection_update(pending_left)
+                if not done:
+                    upstream = backups.popleft()
+                    logger.info(f"{command}: {candidates[0].name} is slower than p95, hedging to {upstream.name}")
+                    launch(upstream)
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if len(launched) > 1:
+                            upstream_hedges.inc(winner=launched[task].name)
+                        return task.result(), launched[task]
+                    error = task.exception()
+                # Отказ API - сразу в резервный, не дожидаясь p95
+                if not pending and backups and (is_upstream_failure(error) or (
+                        isinstance(error, aiohttp.ClientResponseError) and error.status == 429)):
+                    launch(backups.popleft())
+            raise error
+        finally:
+            losers = [task for task in launched if task is not winner]
+            for task in losers:
+                task.cancel()
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[1].aclose()  # Поток проигравшего
+
+    async def _attempt(self, upstream: Upstream, command: str, deadline: float,
+                       start: Callable[[Upstream], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            async with asyncio.timeout(max(0.0, deadline - started)):
+                result = await start(upstream)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self._failed(upstream)
+            raise
+        upstream.breaker.record_success()
+        if upstream is self.upstreams[0]:
+            self.latency.record(command, "first", time.monotonic() - started)
+        return result
+
+    @staticmethod
+    async def _open_stream(data: Dict[str, Any], upstream: Upstream, command: str) -> tuple:
+        """Открывает поток и ждет первого фрагмента: (фрагмент, поток)"""
+        stream = api_client.stream_request(data, upstream, command)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            return "", stream
+        except BaseException:
+            await stream.aclose()
+            raise
+        return first, stream
+
+    async def _consume(self, stream: AsyncIterator[str], first: str, upstream: Upstream, deadline: float,
+                       on_partial: Callable[[str], Awaitable[None]]) -> str:
+        parts = [first]
+        try:
+            async with asyncio.timeout(max(0.0, deadline - time.monotonic())):
+                if first:
+                    await on_partial(first)
+                async for delta in stream:
+                    parts.append(delta)
+                    await on_partial("".join(parts))
+        except Exception as e:
+            if is_upstream_failure(e):
+                self._failed(upstream)
+            raise
+        finally:
+            await stream.aclose()
+        return "".join(parts)
+
+    def _failed(self, upstream: Upstream):
+        if upstream.breaker.record_failure():
+            self._probes[upstream.name] = asyncio.create_task(self._probe(upstream))
+
+    async def _probe(self, upstream: Upstream):
+        """Пока размыкатель разомкнут, проверяет API минимальным запросом"""
+        data = {"messages": [{"role": "user", "content": "ping"}], "max_tokens": 1}
+        while upstream.breaker.is_open:
+            await asyncio.sleep(LLM_BREAKER_PROBE_INTERVAL)
+            try:
+                async with asyncio.timeout(LLM_DEADLINE_MIN):
+                    await api_client.make_request(data, upstream)
+            except Exception as e:
+                logger.info(f"Upstream {upstream.name} probe failed: {e}")
+                continue
+            upstream.breaker.close()
+        self._probes.pop(upstream.name, None)
+
+    async def stop(self):
+        for task in self._probes.values():
+            task.cancel()
+        await asyncio.gather(*self._probes.values(), return_exceptions=True)
+        self._probes.clear()
+
+    def stats(self) -> str:
+        parts = []
+        for upstream in self.upstreams:
+            breaker = upstream.breaker
+            state = (f"недоступен {time.monotonic() - breaker.opened_at:.0f}с" if breaker.is_open
+                     else f"ошибок подряд {breaker.failures}" if breaker.failures else "норма")
+            parts.append(f"{upstream.name}: {state}")
+        return ", ".join(parts) + f"; дедлайн /oracle {self.deadline('oracle'):.0f}с"
+
+
+llm_router = LLMRouter(upstreams)
+
+
+def sanitize_completion(content: str) -> str:
+    # Длинный ответ доставляется несколькими сообщениями, здесь отсекается только явный избыток
+    return safe_slice(content.replace('\0', ''), ANSWER_MAX_CHARS)
+
+
+async def request_completion(
+        data: Dict[str, Any],
+        user_id: int,
+        on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+        command: str = "oracle",
+        background: bool = False
+) -> str:
+    """Выполняет запрос к LLM через планировщик и возвращает очищенный текст ответа.
+
+    Повторяется только ответ 429 - после общей паузы в планировщике. Таймауты и
+    ошибки API не ждут повторной попытки: запасной путь дает LLMRouter.
+    background - фоновая очередь планировщика вместо слота пользователя.
+    """
+    for attempt in range(3):
+        try:
+            async with (llm_scheduler.background_slot() if background else llm_scheduler.slot(user_id)):
+                content = await llm_router.complete(data, command, on_partial)
+            return sanitize_completion(content)
+
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                upstream_retries.inc(reason="rate_limit")
+                # Общая пауза в планировщике; повтор снова встанет в очередь
+                llm_scheduler.report_rate_limited(retry_after_seconds(e, min(2 ** attempt * 30, 240)))
+                continue
+            raise OracleError(f"⚠️ Ошибка сервера ({e.status}). Пожалуйста, попробуйте позже.")
+
+        except asyncio.TimeoutError:
+            raise OracleError("⌛ Время ожидания истекло. Пожалуйста, попробуйте позже.")
+
+        except aiohttp.ClientError as e:
+            logger.warning(f"LLM request failed: {e}")
+            raise OracleError("⚠️ Не удалось связаться с оракулом. Пожалуйста, попробуйте позже.")
+
+    raise OracleError("⏳ Оракул перегружен. Пожалуйста, попробуйте позже.")
+
+
+class ResponseCache:
+    """LRU+TTL кэш ответов с ограничением по памяти и объединением одинаковых запросов.
+
+    Пока для ключа выполняется запрос, остальные обращения ждут его результата,
+    поэтому N одновременных одинаковых команд дают ровно один запрос к API.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value, size)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(command: str, argument: str) -> str:
+        """Ключ кэша: команда + нормализованный аргумент"""
+        normalized = " ".join(argument.lower().replace("ё", "е").split()).strip(" .,!?;:\"'«»")
+        return f"{command}:{normalized}"
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: str):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._discard(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[2]
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[str]]) -> str:
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # Отдельная задача: отмена одного ожидающего не отменяет запрос для остальных
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_loaded(key, t))
+
+        return await asyncio.shield(task)
+
+    def _on_loaded(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self) -> str:
+        total = self.hits + self.misses + self.coalesced
+        hit_rate = (self.hits + self.coalesced) / total * 100 if total else 0.0
+        return (f"попаданий {self.hits}, объединено {self.coalesced}, промахов {self.misses} "
+                f"({hit_rate:.0f}%), записей {len(self._entries)}, {self.size_bytes // 1024} КБ")
+
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая оценка числа токенов без токенизатора.
+
+    Латиница в среднем дает ~4 символа на токен, кириллица и прочие
+    не-ASCII символы - ~2.5; плюс служебные токены на сообщение.
+    """
+    ascii_chars = len(text.encode("ascii", errors="ignore"))
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) / 2.5) + 4
+
+
+# Шаблоны запросов к оракулу
+ORACLE_PERSONA = (
+    "Ты - Оракул, мистический хранитель знаний игры «Игра богов». "
+    "Говоришь образно, используешь метафоры и архетипы, но отвечаешь по существу. "
+    "Отвечай на русском языке."
+)
+
+
+class PromptTemplate:
+    """Шаблон запроса: неизменная системная часть и пользовательский текст в конце.
+
+    Системное сообщение собирается один раз при запуске и передается в каждый
+    запрос тем же объектом, поэтому начало запроса побайтно совпадает между
+    запросами и попадает в кэш префиксов на стороне API.
+    """
+
+    __slots__ = ("name", "system_message", "system_tokens", "user_format")
+
+    def __init__(self, name: str, instruction: str, user_format: str = "{text}"):
+        self.name = name
+        content = f"{ORACLE_PERSONA}\n\n{instruction}"
+        self.system_message = {"role": "system", "content": content}
+        self.system_tokens = estimate_tokens(content)
+        self.user_format = user_format
+
+    def render(self, text: str) -> str:
+        return self.user_format.format(text=text)
+
+
+PROMPTS: Dict[str, PromptTemplate] = {template.name: template for template in (
+    PromptTemplate(
+        "oracle",
+        "Отвечай на вопросы собеседника, учитывая предыдущий диалог."
+    ),
+    PromptTemplate(
+        "анализ",
+        "Собеседник называет тему. Сделай по ней глубокий анализ: выяви закономерности, тренды и связи.",
+        "Тема: {text}"
+    ),
+    PromptTemplate(
+        "знак",
+        "Собеседник называет знак. Объясни его значение и влияние, добавь мифологический контекст.",
+        "Знак: {text}"
+    ),
+    PromptTemplate(
+        "артефакт",
+        "Собеседник называет артефакт. Опиши его свойства и историю. "
+        "Если такого артефакта нет в игре - предложи его концепцию.",
+        "Артефакт: {text}"
+    ),
+    PromptTemplate(
+        "предсказание",
+        "Дай символическое предсказание для текущего момента. Используй метафоры и архетипы.",
+        "Предсказание на сейчас"
+    ),
+    PromptTemplate(
+        "эмоции",
+        "Проанализируй текущую эмоциональную динамику диалога. Учти последние сообщения.",
+        "Эмоциональный срез"
+    ),
+)}
+
+
+class ConversationMemory:
+    """Собирает историю диалога под бюджет токенов и сжимает старые реплики в резюме.
+
+    История хранится парами (роль, текст). Когда она превышает history_tokens,
+    старые реплики в фоне сворачиваются в короткое резюме и удаляются после
+    его получения; запрос пользователя этого не ждет.
+    """
+
+    def __init__(self, budget: int, history_tokens: int, summary_tokens: int):
+        self.budget = budget
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self._summarizing: set = set()
+        self._tasks: set = set()
+
+    def build(self, user_data: UserContext, question: str, template: PromptTemplate) -> List[Dict[str, str]]:
+        """Сообщения для запроса: системная часть шаблона, резюме, свежие реплики в пределах бюджета и вопрос.
+
+        Неизменная часть идет первой, история дописывается в конец - так общий
+        префикс соседних запросов пользователя остается одинаковым.
+        """
+        remaining = self.budget - template.system_tokens - estimate_tokens(question)
+        prefix = [template.system_message]
+        if user_data.summary:
+            summary = f"Краткое содержание предыдущего диалога: {user_data.summary}"
+            prefix.append({"role": "system", "content": summary})
+            remaining -= estimate_tokens(summary)
+
+        history = []
+        for role, content in reversed(user_data.history):
+            remaining -= estimate_tokens(content)
+            if remaining < 0:
+                break
+            history.append({"role": role, "content": content})
+        # Ответ без предшествующего вопроса только путает модель
+        if history and history[-1]["role"] == ROLE_ASSISTANT:
+            history.pop()
+
+        return prefix + history[::-1] + [{"role": "user", "content": question}]
+
+    def remember(self, user_id: int, user_data: UserContext, question: str, answer: str):
+        """Добавляет реплики в историю и при превышении объема запускает сжатие"""
+        # История ограничена CONTEXT_MAX_MESSAGES на случай, если резюме долго не удается получить
+        user_data.append_turn(ROLE_USER, question)
+        user_data.append_turn(ROLE_ASSISTANT, answer)
+
+        total = sum(estimate_tokens(content) for _, content in user_data.history)
+        if total > self.history_tokens and user_id not in self._summarizing:
+            self._summarizing.add(user_id)
+            task = asyncio.create_task(self._compact(user_id, user_data))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Отменяет незавершенные сжатия: реплики остаются в истории до следующего раза"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _compact(self, user_id: int, user_data: UserContext):
+        try:
+            # Сворачиваем старшие реплики, пока в истории не останется половина объема
+            turns = list(user_data.history)
+            keep_tokens = self.history_tokens // 2
+            kept = 0
+            split = len(turns)
+            while split > 0 and kept + estimate_tokens(turns[split - 1][1]) <= keep_tokens:
+                split -= 1
+                kept += estimate_tokens(turns[split][1])
+            split -= split % 2  # Не разрываем пару вопрос-ответ
+            old_turns = turns[:split]
+            if not old_turns:
+                return
+
+            transcript = "\n".join(
+                f"{'Пользователь' if role == ROLE_USER else 'Оракул'}: {safe_slice(content, 1000)}"
+                for role, content in old_turns
+            )
+            data = {
+                "messages": [
+                    {"role": "system", "content": "Ты сжимаешь историю диалога. Пиши кратко, только факты и темы."},
+                    {"role": "user", "content": (
+                        f"Предыдущее резюме: {user_data.summary or 'нет'}\n\n"
+                        f"Новые реплики:\n{transcript}\n\n"
+                        f"Обнови резюме диалога, не более 100 слов."
+                    )}
+                ],
+                "model": LLM_MODEL,
+                "max_tokens": self.summary_tokens,
+                "temperature": 0.2
+            }
+            user_data.summary = await request_completion(data, user_id, command="summary", background=True)
+            # Реплики добавляются в конец, но лимит истории мог за это время вытеснить часть старых
+            summarized = {id(turn) for turn in old_turns}
+            stale = 0
+            for turn in user_data.history:
+                if id(turn) not in summarized:
+                    break
+                stale += 1
+            user_data.drop_oldest(stale)
+            user_repo.mark_dirty(user_id, user_data)
+            logger.debug(f"Compacted {split} messages into summary for user {user_id}")
+        except Exception as e:
+            logger.warning(f"History summarization failed for user {user_id}: {e}")
+        finally:
+            self._summarizing.discard(user_id)
+
+
+conversation_memory = ConversationMemory(
+    budget=CONTEXT_TOKEN_BUDGET,
+    history_tokens=CONTEXT_HISTORY_TOKENS,
+    summary_tokens=CONTEXT_SUMMARY_TOKENS
+)
+
 
+class ResponsePool:
+    """Заранее сгенерированные ответы для команд, у которых запрос всегда одинаковый.
 
-# Инициализация контекстов
-game_context: Dict[int, UserContext] = {}
-admin_context = {}
-logs_buffer = []
+    Пока у планировщика есть свободные слоты, фоновая задача держит для каждой
+    команды до size свежих вариантов; ответ пользователю выдается из пула
+    мгновенно, и один и тот же вариант пользователь не получает дважды.
+    Генерация ограничена бюджетом запросов в час.
+    """
 
-# Загрузка переменных окружения
-logger.info("Loading environment variables")
-load_dotenv()
+    def __init__(self, prompts: List[str], size: int, ttl: float, hourly_budget: int, refill_interval: float):
+        self.size = size
+        self.ttl = ttl
+        self.hourly_budget = hourly_budget
+        self.refill_interval = refill_interval
+        # команда -> [(текст, время создания, кому уже выдан)]
+        self.items: Dict[str, List[tuple]] = {prompt: [] for prompt in prompts} if size > 0 else {}
+        self._generating: Dict[str, int] = {prompt: 0 for prompt in self.items}
+        self._budget_hour = 0
+        self._generated_this_hour = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._requests: set = set()
+        self._exhausted: set = set()  # команды, где пользователю не хватило новых вариантов
+        self.hits = 0
+        self.misses = 0
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-API_URL = os.getenv("API_URL")
-API_KEY = os.getenv("API_KEY")
-ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
+    async def start(self):
+        if self.items:
+            self._task = asyncio.create_task(self._refill_loop())
 
-if not all([BOT_TOKEN, API_URL, API_KEY, ADMIN_ID]):
-    logger.critical("Missing required environment variables")
-    raise ValueError("Missing required environment variables")
+    async def stop(self):
+        tasks = list(self._requests) + ([self._task] if self._task is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-logger.info(f"Admin ID configured as: {ADMIN_ID}")
+    def take(self, prompt: str, user_id: int) -> Optional[str]:
+        """Вариант, который пользователь еще не получал, или None"""
+        items = self.items.get(prompt)
+        if items is None:
+            return None
+        now = time.monotonic()
+        for text, created_at, served in items:
+            if now - created_at < self.ttl and user_id not in served:
+                served.add(user_id)
+                self.hits += 1
+                return text
+        # Пользователь видел все варианты: обновляем пул, а он получит ответ обычным запросом
+        self.misses += 1
+        self._exhausted.add(prompt)
+        self._wakeup.set()
+        return None
 
-# Инициализация бота
-router = Router(name="main")
-logger.info("Initializing bot with configurations")
-# Инициализация бота с увеличенными таймаутами
-bot = Bot(
-    token=BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
-    session_timeout=300,  # 5 минут
-    read_timeout=300,  # 5 минут
-    connect_timeout=60  # 1 минута для установки соединения
-)
+    def _budget_left(self) -> bool:
+        hour = int(time.time()) // 3600
+        if hour != self._budget_hour:
+            self._budget_hour, self._generated_this_hour = hour, 0
+        return self._generated_this_hour < self.hourly_budget
 
+    async def _refill_loop(self):
+        while True:
+            self._refill()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.refill_interval)
+            self._wakeup.clear()
 
-class APIClient:
-    def __init__(self):
-        self.session: Optional[aiohttp.ClientSession] = None
-        # Увеличенные таймауты для API клиента
-        self.timeout = ClientTimeout(
-            total=300,  # Общий таймаут 5 минут
-            connect=60,  # 1 минута на подключение
-            sock_read=600,  # 4 минуты на чтение
-            sock_connect=30  # 30 секунд на установку сокета
-        )
+    def _refill(self):
+        now = time.monotonic()
+        for prompt, items in self.items.items():
+            items[:] = [item for item in items if now - item[1] < self.ttl]
+            # Кому-то не хватило вариантов: самый выдаваемый уступает место новому
+            if prompt in self._exhausted and items and len(items) >= self.size and self._budget_left():
+                items.remove(max(items, key=lambda item: len(item[2])))
+            self._exhausted.discard(prompt)
+            deficit = self.size - len(items) - self._generating[prompt]
+            for _ in range(deficit):
+                if not self._budget_left() or not self._launch(prompt):
+                    return
 
-    @backoff.on_exception(
-        backoff.expo,
-        (aiohttp.ClientError, asyncio.TimeoutError),
-        max_tries=3,
-        max_time=300,  # Увеличенное время для повторных попыток
-        giveup=lambda e: isinstance(e, aiohttp.ClientResponseError) and e.status == 429
-    )
-    async def ensure_session(self):
-        if self.session is None:
-            import aiohttp
-            self.session = aiohttp.ClientSession()
-        return self.session
+    def _launch(self, prompt: str) -> bool:
+        if not llm_scheduler.try_background_slot():
+            return False
+        self._generated_this_hour += 1
+        self._generating[prompt] += 1
+        task = asyncio.create_task(self._generate(prompt))
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+        return True
 
-    async def make_request(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        session = await self.ensure_session()
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
+    async def _generate(self, prompt: str):
+        template = PROMPTS[prompt]
+        data = {
+            "messages": [template.system_message, {"role": "user", "content": template.render("")}],
+            "model": LLM_MODEL,
+            "max_tokens": 1024,
+            "temperature": 0.9,  # Варианты должны различаться
+            "top_p": 0.95
         }
-
         try:
-            async with session.post(API_URL, json=data, headers=headers, timeout=self.timeout) as response:
-                response.raise_for_status()
-                return await response.json()
+            content = sanitize_completion(await llm_router.complete(data, prompt, hedge=False))
+            items = self.items[prompt]
+            if content and all(content != item[0] for item in items):
+                items.append((content, time.monotonic(), set()))
         except aiohttp.ClientResponseError as e:
-            if e.status == 401:
-                logger.error("Unauthorized: Check your API_KEY")
-            raise
+            if e.status == 429:
+                llm_scheduler.report_rate_limited(retry_after_seconds(e, 60))
+            logger.debug(f"Response pool refill for {prompt} failed: {e}")
+        except Exception as e:
+            logger.debug(f"Response pool refill for {prompt} failed: {e}")
+        finally:
+            self._generating[prompt] -= 1
+            llm_scheduler.release_background_slot()
 
-    async def close(self):
-        if self.session and not self.session.closed:
-            await self.session.close()
+    def stats(self) -> str:
+        ready = ", ".join(f"{prompt} {len(items)}" for prompt, items in self.items.items())
+        return (f"{ready or 'отключен'}; выдано {self.hits}, мимо {self.misses}, "
+                f"сгенерировано за час {self._generated_this_hour}/{self.hourly_budget}")
 
-    def __del__(self):
-        if self.session and not self.session.closed:
-            asyncio.create_task(self.session.close())
 
-async def maintain_typing_status(chat_id: int, stop_event: asyncio.Event):
-    """Поддерживает статус печатания с увеличенным интервалом"""
-    logger.debug(f"Starting typing status for chat_id: {chat_id}")
-    try:
-        while not stop_event.is_set():
-            await bot.send_chat_action(chat_id, "typing")
-            await asyncio.sleep(4.9)  # Увеличенный интервал, чуть меньше 5 секунд
-    except Exception as e:
-        logger.error(f"Error in typing status: {e}")
-    finally:
-        logger.debug(f"Stopping typing status for chat_id: {chat_id}")
+response_pool = ResponsePool(
+    ["предсказание", "эмоции"],
+    size=RESPONSE_POOL_SIZE,
+    ttl=RESPONSE_POOL_TTL,
+    hourly_budget=RESPONSE_POOL_HOURLY_BUDGET,
+    refill_interval=RESPONSE_POOL_REFILL_INTERVAL
+)
+
+
+async def get_ai_response(
+        user_id: int,
+        question: str,
+        chat_id: int,
+        on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+        cache_key: Optional[str] = None,
+        prompt: str = "oracle",
+        save_answer: Optional[Callable[[str], Awaitable[bool]]] = None
+) -> str:
+    """Запрос к оракулу по шаблону PROMPTS[prompt]; question - переменная часть.
+    Если передан on_partial, ответ запрашивается потоково и on_partial получает
+    накопленный текст после каждого фрагмента.
 
+    С cache_key запрос отправляется без истории диалога и обслуживается через
+    response_cache, а история пользователя не меняется.
 
-async def get_ai_response(user_id: int, question: str, chat_id: int) -> str:
-    api_client = APIClient()
-    user_data = game_context.setdefault(user_id, init_user_context())
+    save_answer сохраняет ответ до изменения контекста пользователя; если он
+    вернул False (ответ уже сохранил другой запуск того же задания), история и
+    счетчики не меняются повторно.
+    """
+    user_data = await user_repo.get(user_id)
 
-    if user_data["banned"]:
+    if user_data.banned:
         return "🚫 Ваш доступ к оракулу ограничен"
 
-    messages = user_data["messages"][-4:] + [{"role": "user", "content": safe_slice(question, 2000)}]
+    pooled = response_pool.take(prompt, user_id)
+    if pooled is not None:
+        if save_answer is None or await save_answer(pooled):
+            record_user_request(user_id, user_data)
+        return pooled
+
+    template = PROMPTS[prompt]
+    question = template.render(safe_slice(question, 2000))
+    if cache_key:
+        messages = [template.system_message, {"role": "user", "content": question}]
+    else:
+        messages = conversation_memory.build(user_data, question, template)
     data = {
         "messages": messages,
-        "model": "deepseek-ai/DeepSeek-V3",
+        "model": LLM_MODEL,
         "max_tokens": 1024,
         "temperature": 0.4,
         "top_p": 0.9
     }
 
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(maintain_typing_status(chat_id, stop_typing))
-
     try:
-        for attempt in range(3):
+        async with typing_presence.hold(chat_id):
+            if cache_key:
+                sanitized_response = await response_cache.get_or_load(
+                    cache_key, lambda: request_completion(data, user_id, on_partial, command=prompt))
+            else:
+                sanitized_response = await request_completion(data, user_id, on_partial, command=prompt)
+    except OracleError as e:
+        return str(e)
+
+    if save_answer is not None and not await save_answer(sanitized_response):
+        return sanitized_response
+    if not cache_key:
+        conversation_memory.remember(user_id, user_data, question, sanitized_response)
+    record_user_request(user_id, user_data)
+    return sanitized_response
+
+
+def record_user_request(user_id: int, user_data: UserContext):
+    """Учитывает обслуженный запрос: счетчик сообщений и время активности"""
+    user_data.blocked = False
+    user_data.message_count += 1
+    now = int(time.time())
+    admin_stats.record_activity(user_data.last_active, now)
+    user_data.last_active = now
+    user_repo.mark_dirty(user_id, user_data)
+
+
+class LLMJobQueue:
+    """Долговечная очередь заданий оракула.
+
+    Обработчик команды сохраняет задание в хранилище и сразу освобождается; пул
+    исполнителей забирает задания и доставляет ответ по chat_id и message_id.
+    При нескольких процессах задание берет процесс, обрабатывающий апдейты его
+    чата (chat_id % WEB_WORKERS), - контекст пользователя меняется только в нем.
+    Задание с истекшей арендой (процесс упал) снова берется в работу. Ответ сохраняется до доставки, а доставка правит ту же заглушку,
+    поэтому повтор не генерирует ответ заново и не дублирует его.
+    """
+
+    EMPTY_ANSWER = "⚠️ Оракул молчит. Пожалуйста, попробуйте позже."
+    FAILED_ANSWER = "⚠️ Оракул не смог ответить. Пожалуйста, задайте вопрос еще раз."
+
+    def __init__(self, workers: int, lease: float, max_attempts: int, poll_interval: float):
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.running: Dict[int, asyncio.Task] = {}
+        self.latencies: deque = deque(maxlen=1000)
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def submit(self, message: Message, prompt: str, question: str, header: str,
+                     cached: bool = False, stream: bool = False):
+        """Ставит запрос в очередь; при потоковой выдаче сразу отвечает заглушкой"""
+        reply = StreamingReply(message.chat.id, message.message_id, header, message.chat.type == "private")
+        if stream and STREAM_RESPONSES:
+            await reply.start()
+        await user_repo.store.create_job({
+            "chat_id": message.chat.id, "chat_type": message.chat.type, "user_id": message.from_user.id,
+            "reply_to": message.message_id, "message_id": reply.message_id, "prompt": prompt,
+            "question": question, "header": header, "cached": cached, "created_at": time.time()
+        })
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def start(self):
+        if self.workers > 0:
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self):
+        next_renew = next_purge = 0.0
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            jobs = []
+            free = self.workers - len(self.running)
             try:
-                response_data = await api_client.make_request(data)
-                if not isinstance(response_data.get("choices"), list) or not response_data["choices"]:
-                    raise ValueError("Invalid API response structure")
-
-                content = response_data["choices"][0].get("message", {}).get("content", "")
-                sanitized_response = safe_slice(content.replace('\0', ''), 4000)
-
-                user_data.update({
-                    "messages": messages + [{"role": "assistant", "content": sanitized_response}],
-                    "message_count": user_data["message_count"] + 1,
-                    "last_active": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                game_context[user_id] = user_data
-
-                return sanitized_response
-
-            except aiohttp.ClientResponseError as e:
-                if e.status == 429:
-                    wait_time = min(2 ** attempt * 30, 240)  # Увеличенное время ожидания между попытками
-                    logger.warning(f"Rate limit exceeded, waiting {wait_time}s")
-                    await asyncio.sleep(wait_time)
-                    continue
-                return f"⚠️ Ошибка сервера ({e.status}). Пожалуйста, попробуйте позже."
+                if free > 0:
+                    jobs = await user_repo.store.claim_jobs(free, now, now + self.lease, WORKER_ID, WEB_WORKERS)
+                if now >= next_renew:
+                    await user_repo.store.renew_jobs(list(self.running), now + self.lease)
+                    next_renew = now + self.lease / 3
+                if now >= next_purge:
+                    await user_repo.store.purge_jobs(now - 24 * 3600)
+                    next_purge = now + 3600
+            except Exception as e:
+                logger.error(f"LLM job queue error: {e}")
 
-            except asyncio.TimeoutError:
-                if attempt < 2:
-                    wait_time = min(2 ** attempt * 30, 240)
-                    logger.warning(f"Request timeout, attempt {attempt + 1}/3, waiting {wait_time}s")
-                    await asyncio.sleep(wait_time)
-                    continue
-                return "⌛ Время ожидания истекло. Пожалуйста, попробуйте позже."
+            for job in jobs:
+                if job["id"] in self.running:
+                    continue  # Аренда истекла, пока задание еще выполняется здесь же
+                task = asyncio.create_task(self._run(job))
+                self.running[job["id"]] = task
+                task.add_done_callback(lambda done, job_id=job["id"]: self._finished(job_id, done))
+            if jobs and len(jobs) == free:
+                continue  # Пул заполнен: следующий круг после завершения задания
+            if not jobs and not self.running:
+                self._idle.set()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    def _finished(self, job_id: int, task: asyncio.Task):
+        self.running.pop(job_id, None)
+        self._wakeup.set()
+        if not task.cancelled() and task.exception() is not None:
+            # Например, хранилище недоступно; задание вернется в работу по истечении аренды
+            logger.error(f"LLM job {job_id} crashed: {task.exception()}")
+
+    async def _run(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        reply = StreamingReply(job["chat_id"], job["reply_to"], job["header"], job["chat_type"] == "private",
+                               message_id=job["message_id"], parts_sent=job["parts_sent"])
+
+        async def save_progress():
+            await user_repo.store.update_job(job_id, message_id=reply.message_id, parts_sent=reply.parts_sent)
 
-    finally:
-        stop_typing.set()
         try:
-            await asyncio.wait_for(typing_task, timeout=10)  # Увеличенный таймаут для остановки typing
-        except asyncio.TimeoutError:
-            typing_task.cancel()
+            if job["attempts"] > self.max_attempts:
+                await self._fail(job, reply)
+                return
+            answer = job["answer"]
+            if not answer:
+                # Ответ сохраняется раньше, чем меняется история: повтор задания после
+                # сбоя доставляет сохраненный ответ и не дописывает историю второй раз
+                answer = await get_ai_response(
+                    job["user_id"], job["question"], job["chat_id"],
+                    on_partial=reply.update if reply.message_id is not None else None,
+                    cache_key=ResponseCache.make_key(job["prompt"], job["question"]) if job["cached"] else None,
+                    prompt=job["prompt"],
+                    save_answer=lambda text: user_repo.store.save_job_answer(job_id, text)
+                ) or self.EMPTY_ANSWER
+                await user_repo.store.save_job_answer(job_id, answer)
+            await reply.finish(answer, on_progress=save_progress)
+            await user_repo.store.update_job(job_id, status="done", message_id=reply.message_id, lease_until=None)
+            self._observe(job, "done")
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Чат недоступен - повтор не поможет
+            logger.warning(f"LLM job {job_id} undeliverable: {e}")
+            if isinstance(e, TelegramForbiddenError) and job["chat_type"] == "private":
+                await user_repo.mark_blocked(job["user_id"])
+            await user_repo.store.update_job(job_id, status="failed", lease_until=None)
+            self._observe(job, "undeliverable")
+        except Exception as e:
+            delay = min(5 * 2 ** job["attempts"], 300)
+            logger.error(f"LLM job {job_id} failed (attempt {job['attempts']}), retry in {delay}s: {e}",
+                         exc_info=True)
+            await user_repo.store.update_job(job_id, status="queued", lease_until=None,
+                                             available_at=time.time() + delay)
+
+    async def _fail(self, job: Dict[str, Any], reply: StreamingReply):
+        logger.error(f"LLM job {job['id']} gave up after {job['attempts'] - 1} attempts")
+        try:
+            await reply.finish(self.FAILED_ANSWER)
+        except Exception as e:
+            logger.warning(f"Failed to notify about LLM job {job['id']}: {e}")
+        await user_repo.store.update_job(job["id"], status="failed", lease_until=None)
+        self._observe(job, "failed")
+
+    def _observe(self, job: Dict[str, Any], status: str):
+        seconds = time.time() - job["created_at"]
+        llm_job_seconds.observe(seconds, command=job["prompt"], status=status)
+        if status == "done":
+            self.latencies.append(seconds)
+        else:
+            self.failed += 1
+
+    async def join(self):
+        """Ждет, пока в очереди не останется заданий, доступных этому процессу"""
+        self._idle.clear()
+        self._wakeup.set()
+        await self._idle.wait()
+
+    async def drain(self, timeout: float):
+        """Остановка: новые задания не берутся, начатые дорабатываются до timeout,
+        остальные возвращаются в очередь для следующего запуска"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+        if not self.running:
+            return
+
+        logger.info(f"Draining {len(self.running)} LLM jobs, up to {timeout:g}s")
+        tasks = dict(self.running)
+        _, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+        if not pending:
+            return
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        interrupted = [job_id for job_id, task in tasks.items() if task in pending]
+        await user_repo.store.release_jobs(interrupted)
+        logger.warning(f"Drain deadline reached, {len(interrupted)} LLM jobs returned to the queue")
+
+    def stats(self) -> str:
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        return f"выполняется {len(self.running)}/{self.workers}, ответ p95 {p95:.1f}с, неудач {self.failed}"
+
+
+llm_jobs = LLMJobQueue(
+    workers=LLM_JOB_WORKERS,
+    lease=LLM_JOB_LEASE,
+    max_attempts=LLM_JOB_MAX_ATTEMPTS,
+    poll_interval=LLM_JOB_POLL_INTERVAL
+)
 
 
-# Add to main() function:
 async def cleanup():
-    """Cleanup function to close the API client session"""
+    """Дорабатывает задания оракула, закрывает общий клиент API и сбрасывает несохраненные контексты"""
+    await llm_jobs.drain(LLM_JOB_DRAIN_TIMEOUT)
+    await conversation_memory.stop()
+    await response_pool.stop()
+    await broadcast_engine.stop()
+    await profile_index.stop()
+    await admin_stats.stop()
+    await llm_router.stop()
     await api_client.close()
+    await user_repo.close()
 
 
-async def main():
+async def startup(background_jobs: bool = True) -> Optional[web.AppRunner]:
+    """Запускает компоненты бота и эндпоинт метрик.
+
+    Задачи по всей базе (возобновление рассылок, дозагрузка профилей) при нескольких
+    процессах выполняет только один из них.
+    """
+    dp.include_router(router)
+    await user_repo.start()
+    await admin_stats.start()
+    await api_client.start()
+    await profile_index.start(enqueue_missing=background_jobs)
+    if background_jobs:
+        await broadcast_engine.start()
+    # Бюджет пула ответов общий на все процессы
+    response_pool.hourly_budget = max(1, response_pool.hourly_budget // WEB_WORKERS)
+    await response_pool.start()
+    await llm_jobs.start()
+    return await start_metrics_server()
+
+
+async def shutdown(metrics_runner: Optional[web.AppRunner]):
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await cleanup()
+
+
+# Прием апдейтов через вебхук
+def update_chat_id(payload: Dict[str, Any]) -> int:
+    """ID чата апдейта: по нему апдейты распределяются по процессам и упорядочиваются.
+
+    Для апдейтов без чата (инлайн-запросы, платежи) - ID отправителя.
+    """
+    for value in payload.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+    return payload.get("update_id", 0)
+
+
+def event_chat_id(update: Update) -> int:
+    """То же, что update_chat_id, для уже разобранного апдейта (long polling)"""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    sender = getattr(event, "from_user", None) or getattr(event, "user", None)
+    return sender.id if sender is not None else update.update_id
+
+
+class UpdateDispatcher:
+    """Пул обработки апдейтов вокруг dp: апдейты одного чата обрабатываются строго
+    по очереди, разных чатов - параллельно, но не больше concurrency одновременно.
+
+    Чат с ожидающими апдейтами стоит в одной из двух очередей готовности по классу
+    первого апдейта: «slow» - команды оракула, «fast» - все остальное (меню, кнопки,
+    /start). Медленным достается не больше concurrency - fast_reserve слотов, и
+    быстрые команды не ждут за командами оракула. После каждого апдейта чат уходит
+    в конец очереди готовности, так что активный чат не задерживает остальные.
+
+    Переполнение очереди чата вытесняет самый старый апдейт (drop_oldest) или
+    отклоняет новый (drop_new). При переполнении общей очереди прием апдейтов
+    ждет места (wait: поллинг не запрашивает новые, вебхук отвечает позже) или
+    апдейт отбрасывается (drop).
+    """
+
+    def __init__(self, concurrency: int, fast_reserve: int, max_pending: int, max_chat_pending: int,
+                 overflow: str = "wait", chat_overflow: str = "drop_oldest"):
+        self.concurrency = concurrency
+        self.slow_limit = concurrency - fast_reserve
+        self.max_pending = max_pending
+        self.max_chat_pending = max_chat_pending
+        self.overflow = overflow
+        self.chat_overflow = chat_overflow
+        self._queues: Dict[int, deque] = {}  # chat_id -> deque[(апдейт, время постановки)]
+        self._ready = {"fast": deque(), "slow": deque()}
+        self._active = {"fast": 0, "slow": 0}
+        self._tasks: set = set()
+        self.waiters: deque = deque()  # Futures источников, ждущих места в очереди
+        self.pending = 0
+        self.dropped = 0
+
+    @staticmethod
+    def lane(update: Update) -> str:
+        return "slow" if ThrottlingMiddleware.command_class(update.message) == "llm" else "fast"
+
+    @property
+    def running(self) -> int:
+        return self._active["fast"] + self._active["slow"]
+
+    @property
+    def ready_chats(self) -> int:
+        return len(self._ready["fast"]) + len(self._ready["slow"])
+
+    async def submit(self, chat_id: int, update: Update) -> bool:
+        """Ставит апдейт в очередь чата; False - апдейт отброшен по политике переполнения"""
+        while self.pending >= self.max_pending:
+            if self.overflow != "wait":
+                self._drop(update, "queue_full")
+                return False
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if not waiter.done():
+                    self.waiters.remove(waiter)
+
+        pending = self._queues.get(chat_id)
+        if pending is None:
+            pending = self._queues[chat_id] = deque()
+            scheduled = False
+        else:
+            # Чат уже в очереди готовности или обрабатывается - его запустит _process
+            scheduled = True
+        if len(pending) >= self.max_chat_pending:
+            if self.chat_overflow == "drop_new":
+                self._drop(update, "chat_full")
+                return False
+            self._drop(pending.popleft()[0], "chat_full")
+            self.pending -= 1
+        pending.append((update, time.monotonic()))
+        self.pending += 1
+        if not scheduled:
+            self._schedule(chat_id)
+            self._start_ready()
+        return True
+
+    def _drop(self, update: Update, reason: str):
+        self.dropped += 1
+        dispatch_dropped.inc(reason=reason)
+        logger.warning(f"Update {update.update_id} dropped: {reason}")
+
+    def _schedule(self, chat_id: int):
+        self._ready[self.lane(self._queues[chat_id][0][0])].append(chat_id)
+
+    def _start_ready(self):
+        while self.running < self.concurrency:
+            if self._ready["fast"]:
+                lane = "fast"
+            elif self._ready["slow"] and self._active["slow"] < self.slow_limit:
+                lane = "slow"
+            else:
+                return
+            chat_id = self._ready[lane].popleft()
+            update, queued_at = self._queues[chat_id].popleft()
+            self.pending -= 1
+            self._wake()
+            self._active[lane] += 1
+            dispatch_running.inc(lane=lane)
+            dispatch_wait_seconds.observe(time.monotonic() - queued_at, lane=lane)
+            task = asyncio.create_task(self._process(chat_id, lane, update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _wake(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def _process(self, chat_id: int, lane: str, update: Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.exception(f"Failed to process update {update.update_id}: {e}")
+        finally:
+            self._active[lane] -= 1
+            dispatch_running.dec(lane=lane)
+            if self._queues[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self._queues[chat_id]
+            self._start_ready()
+
+    async def join(self, timeout: Optional[float] = None):
+        """Ждет обработки уже принятых апдейтов"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                logger.warning(f"Update dispatcher stopped with {self.pending} updates pending")
+                return
+            await asyncio.wait(set(self._tasks), timeout=remaining)
+
+    def stats(self) -> str:
+        return (f"{self.running} в работе (оракул {self._active['slow']}), {self.pending} в очереди "
+                f"из {len(self._queues)} чатов, отброшено {self.dropped}")
+
+
+update_dispatcher = UpdateDispatcher(
+    concurrency=UPDATE_CONCURRENCY, fast_reserve=UPDATE_FAST_RESERVE, max_pending=UPDATE_QUEUE_SIZE,
+    max_chat_pending=UPDATE_CHAT_QUEUE_SIZE, overflow=UPDATE_OVERFLOW, chat_overflow=UPDATE_CHAT_OVERFLOW
+)
+
+
+class UpdatePoller:
+    """Long polling без aiogram.start_polling: апдейты уходят в update_dispatcher.
+
+    Следующий getUpdates запрашивается, только когда диспетчер принял все апдейты
+    предыдущего ответа, так что при UPDATE_OVERFLOW=wait необработанные апдейты
+    остаются на стороне Telegram, а не в памяти процесса.
+    """
+
+    MAX_BACKOFF = 30
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self.offset: Optional[int] = None
+
+    async def run(self):
+        allowed_updates = dp.resolve_used_update_types()
+        request_timeout = int(bot.session.timeout + self.timeout)
+        backoff = 1.0
+        logger.info(f"Polling started, {UPDATE_CONCURRENCY} concurrent updates")
+        while True:
+            try:
+                updates = await bot.get_updates(offset=self.offset, timeout=self.timeout,
+                                                allowed_updates=allowed_updates, request_timeout=request_timeout)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramAPIError as e:
+                logger.error(f"getUpdates failed: {e}, retrying in {backoff:g}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            for update in updates:
+                await update_dispatcher.submit(event_chat_id(update), update)
+                self.offset = update.update_id + 1
+
+    async def confirm(self):
+        """Подтверждает принятые апдейты, чтобы после перезапуска они не пришли повторно"""
+        if self.offset is None:
+            return
+        try:
+            await bot.get_updates(offset=self.offset, limit=1, timeout=0)
+        except TelegramAPIError as e:
+            logger.warning(f"Failed to confirm update offset {self.offset}: {e}")
+
+
+class WebhookServer:
+    """HTTP-прием апдейтов: проверяет секрет и передает апдейт обработчику по ID чата.
+
+    Без очередей процессов апдейты обрабатываются в этом же процессе; иначе апдейт
+    уходит в очередь процесса chat_id % WEB_WORKERS, так что апдейты одного чата
+    всегда обрабатывает один процесс и в порядке поступления.
+    """
+
+    def __init__(self, queues: Optional[List[Any]] = None):
+        self.queues = queues
+
+    async def handle(self, request: web.Request) -> web.Response:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        chat_id = update_chat_id(payload)
+        if self.queues is None:
+            # При UPDATE_OVERFLOW=wait ответ задерживается, пока в очереди нет места
+            await update_dispatcher.submit(chat_id, Update.model_validate(payload, context={"bot": bot}))
+            return web.Response()
+        try:
+            self.queues[chat_id % len(self.queues)].put_nowait(payload)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            logger.warning(f"Worker queue is full, update {payload.get('update_id')} rejected")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        return runner
+
+
+def next_update(updates: Any, parent_pid: int) -> Optional[Dict[str, Any]]:
+    """Блокирующее чтение очереди процесса-обработчика; None - пора завершаться"""
+    while True:
+        try:
+            return updates.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                return None  # Главный процесс завершился, не дождавшись нас
+
+
+async def serve_worker(updates: Any, parent_pid: int):
+    loop = asyncio.get_running_loop()
+    metrics_runner = await startup(background_jobs=WORKER_ID == 0)
+    logger.info(f"Worker {WORKER_ID} started")
+    try:
+        while True:
+            payload = await loop.run_in_executor(None, next_update, updates, parent_pid)
+            if payload is None:
+                break
+            await update_dispatcher.submit(update_chat_id(payload), Update.model_validate(payload, context={"bot": bot}))
+        await update_dispatcher.join()
+    finally:
+        await shutdown(metrics_runner)
+        await bot.session.close()
+        logger.info(f"Worker {WORKER_ID} stopped")
+
+
+def run_worker(updates: Any, parent_pid: int):
+    """Точка входа процесса-обработчика. Сигналы остановки обрабатывает главный процесс"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(serve_worker(updates, parent_pid))
+
+
+def spawn_workers() -> tuple:
+    """Запускает WEB_WORKERS процессов; у каждого свой лог и порт метрик"""
+    context = multiprocessing.get_context("spawn")
+    queues, processes = [], []
+    log_base, log_ext = os.path.splitext(LOG_FILE)
+    for index in range(WEB_WORKERS):
+        updates = context.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        # Дочерний процесс заново импортирует модуль и читает настройки из окружения
+        os.environ.update(
+            WORKER_ID=str(index),
+            LOG_FILE=f"{log_base}.worker{index}{log_ext}",
+            METRICS_PORT=str(METRICS_PORT + index if METRICS_PORT else 0)
+        )
+        process = context.Process(target=run_worker, args=(updates, os.getpid()), name=f"worker-{index}")
+        process.start()
+        queues.append(updates)
+        processes.append(process)
+    return queues, processes
+
+
+async def stop_workers(queues: List[Any], processes: List[Any], timeout: float = 60):
+    for updates in queues:
+        updates.put(None)
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.warning(f"{process.name} did not stop in time, terminating")
+            process.terminate()
+
+
+async def run_webhook():
+    """Режим вебхука: регистрирует адрес в Telegram и принимает апдейты до сигнала остановки"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    queues, processes, metrics_runner = None, [], None
+    if WEB_WORKERS > 1:
+        queues, processes = spawn_workers()
+        dp.include_router(router)  # Нужен только для списка используемых типов апдейтов
+    else:
+        metrics_runner = await startup()
+    server = WebhookServer(queues)
+    runner = await server.serve()
+    try:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+        logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}, {WEB_WORKERS} worker(s)")
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать апдейты, затем дообрабатываем принятые
+        await runner.cleanup()
+        if queues is not None:
+            await stop_workers(queues, processes)
+        else:
+            await update_dispatcher.join(timeout=60)
+            await shutdown(metrics_runner)
+        await bot.session.close()
+
+
+async def run_polling():
+    """Режим long polling: принимает апдейты до сигнала остановки"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    metrics_runner = await startup()
+    poller = UpdatePoller(POLLING_TIMEOUT)
     try:
-        dp.include_router(router)
-        await dp.start_polling(bot)
+        # После работы через вебхук getUpdates недоступен, пока вебхук не снят
+        await bot.delete_webhook()
+        polling = asyncio.create_task(poller.run())
+        await asyncio.wait([polling, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+        polling.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await polling
+        await poller.confirm()
+        await update_dispatcher.join(timeout=60)
     finally:
-        await cleanup()
+        # Сессия бота нужна до конца остановки: дорабатываемые задания доставляют ответы
+        await shutdown(metrics_runner)
+        await bot.session.close()
+
+
+async def main():
+    if WEBHOOK_URL:
+        await run_webhook()
+    else:
+        await run_polling()
 
 
 # Вспомогательные функции
@@ -227,25 +4223,14 @@ def safe_slice(data: Any, max_len: int, default: str = "") -> str:
 
 def init_user_context() -> UserContext:
     """Инициализация контекста пользователя"""
-    return {
-        "messages": [],
-        "message_count": 0,
-        "last_active": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "banned": False
-    }
+    return UserContext(last_active=int(time.time()))
 
 
-async def maintain_typing_status(chat_id: int, stop_event: asyncio.Event):
-    """Поддерживает статус печатания"""
-    logger.debug(f"Starting typing status for chat_id: {chat_id}")
-    try:
-        while not stop_event.is_set():
-            await bot.send_chat_action(chat_id, "typing")
-            await asyncio.sleep(4)
-    except Exception as e:
-        logger.error(f"Error in typing status: {e}")
-    finally:
-        logger.debug(f"Stopping typing status for chat_id: {chat_id}")
+def format_timestamp(timestamp: int) -> str:
+    """Время epoch в читаемом виде для админки и экспорта"""
+    if not timestamp:
+        return "N/A"
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
 
 @router.message(Command(commands=["start", "help", "menu"]))
@@ -300,21 +4285,8 @@ async def cmd_oracle(message: Message, command: CommandObject):
         await message.answer("🔮 Я здесь! Задайте свой вопрос после команды, например:\n/oracle как пройдет мой день?")
         return
 
-    # Создаем и запускаем задачу с typing статусом
-    stop_typing = asyncio.Event()
-    typing_task = asyncio.create_task(maintain_typing_status(message.chat.id, stop_typing))
-
-    try:
-        response = await get_ai_response(
-            message.from_user.id,
-            command.args,
-            message.chat.id
-        )
-        await message.reply(f"🔮 Ответ Оракула:\n\n{response}")
-    finally:
-        # Останавливаем typing статус
-        stop_typing.set()
-        await typing_task
+    # Ответ генерирует и доставляет пул llm_jobs; статус «печатает» - через typing_presence
+    await llm_jobs.submit(message, "oracle", command.args, "🔮 Ответ Оракула:\n\n", stream=True)
 
 @router.message(Command("анализ"))
 async def cmd_analysis(message: Message, command: CommandObject):
@@ -326,35 +4298,15 @@ async def cmd_analysis(message: Message, command: CommandObject):
         await message.answer("🌀 Укажите тему для анализа после команды, например:\n/анализ судьба мира")
         return
 
-    try:
-        logger.info(f"Getting analysis for topic: {command.args}")
-        response = await get_ai_response(
-            message.from_user.id,
-            f"Сделай глубокий анализ по теме: {command.args}. Выяви закономерности, тренды и связи.",
-            message.chat.id
-        )
-
-        if response:
-            logger.info(f"Analysis response received for user {message.from_user.id}")
-            await message.reply(f"🌀 Анализ вселенной по теме '{command.args}':\n\n{response}")
-        else:
-            logger.error(f"Empty analysis response for user {message.from_user.id}")
-            await message.reply("⚠️ Не удалось получить анализ. Пожалуйста, попробуйте позже.")
-    except Exception as e:
-        logger.error(f"Error in analysis command: {e}", exc_info=True)
-        await message.reply("Произошла ошибка при выполнении анализа")
+    await llm_jobs.submit(message, "анализ", command.args, f"🌀 Анализ вселенной по теме '{command.args}':\n\n",
+                          cached=True, stream=True)
 
 
 
 @router.message(Command("эмоции"))
 async def cmd_emotions(message: Message):
     """Обработка команды /эмоции"""
-    response = await get_ai_response(
-        message.from_user.id,
-        "Проанализируй текущую эмоциональную динамику в этом чате. Учти последние сообщения.",
-        message.chat.id
-    )
-    await message.reply(f"🌌 Эмоциональный срез реальности:\n\n{response}")
+    await llm_jobs.submit(message, "эмоции", "", "🌌 Эмоциональный срез реальности:\n\n")
 
 @router.message(Command("знак"))
 async def cmd_sign(message: Message, command: CommandObject):
@@ -363,12 +4315,7 @@ async def cmd_sign(message: Message, command: CommandObject):
         await message.answer("🌠 Укажите название знака после команды, например:\n/знак скорпион")
         return
 
-    response = await get_ai_response(
-        message.from_user.id,
-        f"Объясни значение и влияние знака: {command.args}. Добавь мифологический контекст.",
-        message.chat.id
-    )
-    await message.reply(f"🌠 Тайна знака '{command.args}':\n\n{response}")
+    await llm_jobs.submit(message, "знак", command.args, f"🌠 Тайна знака '{command.args}':\n\n", cached=True)
 
 @router.message(Command("артефакт"))
 async def cmd_artifact(message: Message, command: CommandObject):
@@ -377,22 +4324,13 @@ async def cmd_artifact(message: Message, command: CommandObject):
         await message.answer("💎 Укажите название артефакта после команды, например:\n/артефакт меч судьбы")
         return
 
-    response = await get_ai_response(
-        message.from_user.id,
-        f"Опиши свойства и историю артефакта: {command.args}. Если его нет в игре - предложи концепцию.",
-        message.chat.id
-    )
-    await message.reply(f"💊 Тайны артефакта '{command.args}':\n\n{response}")
+    await llm_jobs.submit(message, "артефакт", command.args, f"💊 Тайны артефакта '{command.args}':\n\n",
+                          cached=True)
 
 @router.message(Command("предсказание"))
 async def cmd_prophecy(message: Message):
     """Обработка команды /предсказание"""
-    response = await get_ai_response(
-        message.from_user.id,
-        "Дай символическое предсказание для текущего момента. Используй метафоры и архетипы.",
-        message.chat.id
-    )
-    await message.reply(f"🌪 Пророчество на сейчас:\n\n{response}")
+    await llm_jobs.submit(message, "предсказание", "", "🌪 Пророчество на сейчас:\n\n")
 
 
 @router.message(Command("admin"))
@@ -402,18 +4340,15 @@ async def admin_panel(message: Message):
         await message.answer("🚫 Недостаточно прав!")
         return  # Явный возврат вместо неявного
 
-    # Обновленная статистика
-    active_users = sum(1 for u in game_context.values() if u.get('last_active'))
-    banned_users = sum(1 for u in game_context.values() if u.get('banned', False))
-
-    stats = (
-        f"📊 <b>Статистика системы:</b>\n"
-        f"👥 Всего пользователей: {len(game_context)}\n"
-        f"💬 Активных (7 дней): {active_users}\n"
-        f"🚫 Заблокированных: {banned_users}"
+    await message.answer(
+        admin_stats.render(),
+        reply_markup=admin_keyboard(),
+        parse_mode=ParseMode.HTML
     )
 
-    # Обновленная клавиатура
+
+def admin_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура панели администратора"""
     builder = InlineKeyboardBuilder()
     builder.row(
         InlineKeyboardButton(text="📤 Рассылка", callback_data="admin_broadcast"),
@@ -424,14 +4359,10 @@ async def admin_panel(message: Message):
         InlineKeyboardButton(text="📦 Экспорт", callback_data="admin_export")
     )
     builder.row(
+        InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics"),
         InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_refresh")
     )
-
-    await message.answer(
-        stats,
-        reply_markup=builder.as_markup(),
-        parse_mode=ParseMode.HTML
-    )
+    return builder.as_markup()
 
 @router.callback_query(F.data.startswith("admin_"))
 async def handle_admin_actions(callback: CallbackQuery, state: FSMContext):
@@ -447,78 +4378,199 @@ async def handle_admin_actions(callback: CallbackQuery, state: FSMContext):
         await state.set_state("admin_broadcast_text")
 
     elif action == "logs":
-        log_file = StringIO()
-        log_file.write("\n".join(logs_buffer[-100:]))
-        log_file.seek(0)
-        await callback.message.answer_document(
-            document=BufferedInputFile(log_file.read().encode(), filename="logs.txt"))
+        # admin_logs или admin_logs_<LEVEL>
+        level_name = callback.data.split("_")[2] if callback.data.count("_") >= 2 else "NOTSET"
+        await send_logs(callback.message, logging.getLevelName(level_name))
 
     elif action == "export":
-        # Генерация CSV файла
-        csv_file = StringIO()
-        writer = csv.writer(csv_file)
-        writer.writerow(["ID", "Last Active", "Messages", "Banned"])
-
-        for user_id, data in game_context.items():
-            writer.writerow([
-                user_id,
-                data.get('last_active', 'N/A'),
-                data.get('message_count', 0),
-                data.get('banned', False)
-            ])
+        await send_export(callback.message)
 
-        csv_file.seek(0)
-        await callback.message.answer_document(
-            document=BufferedInputFile(csv_file.read().encode(), filename="users_export.csv")
-        )
+    elif action == "metrics":
+        await callback.message.answer(metrics_summary(), parse_mode=ParseMode.HTML)
 
     elif action == "search":
         await callback.message.answer("🔍 Введите ID пользователя или имя:")
         await state.set_state("admin_search_user")
 
-    await callback.answer()
+    elif action == "refresh":
+        with contextlib.suppress(TelegramBadRequest):  # message is not modified
+            await callback.message.edit_text(
+                admin_stats.render(), reply_markup=admin_keyboard(), parse_mode=ParseMode.HTML
+            )
 
+    await callback.answer()
 
-@router.message(F.text, StateFilter("admin_broadcast_text"))
-async def process_broadcast(message: Message, state: FSMContext):
-    """Обработка текста рассылки"""
-    success = 0
-    failed = 0
 
-    for user_id in game_context:
-        try:
-            await bot.send_message(user_id, f"📢 Рассылка:\n\n{message.text}")
-            success += 1
-        except Exception as e:
-            failed += 1
-            logs_buffer.append(f"Failed to send to {user_id}: {str(e)}")
+async def send_logs(message: Message, min_level: int = logging.NOTSET, user_id: Optional[int] = None,
+                    limit: int = 100):
+    """Отправляет выборку из кольцевого буфера логов файлом"""
+    content = logs_buffer.export(min_level, user_id, limit)
+    if not content:
+        await message.answer("📝 Подходящих записей в логе нет")
+        return
 
-    await message.answer(
-        f"✅ Рассылка завершена:\n"
-        f"• Успешно: {success}\n"
-        f"• Не удалось: {failed}"
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="Все", callback_data="admin_logs"),
+        InlineKeyboardButton(text="⚠️ WARNING+", callback_data="admin_logs_WARNING"),
+        InlineKeyboardButton(text="❌ ERROR+", callback_data="admin_logs_ERROR")
     )
+    await message.answer_document(
+        document=BufferedInputFile(content, filename="logs.txt"),
+        caption=f"📝 Записей в буфере: {len(logs_buffer)}. Фильтр: /logs [уровень] [user=ID] [limit=N]",
+        reply_markup=builder.as_markup()
+    )
+
+
+async def export_users(path: str, export_format: str = "csv", **filters) -> int:
+    """Потоковая выгрузка пользователей в gzip-файл (CSV или JSON Lines).
+
+    Строки читаются из хранилища пачками, сжатие идет в отдельном потоке,
+    поэтому в памяти одновременно находится не больше одной пачки.
+    """
+    await user_repo.flush()
+    count = 0
+    with open(path, "wb") as file, gzip.GzipFile(fileobj=file, mode="wb") as archive:
+        if export_format == "csv":
+            await asyncio.to_thread(archive.write, "ID,Last Active,Messages,Banned\r\n".encode())
+
+        async for chunk in user_repo.store.iter_export_rows(chunk_size=EXPORT_CHUNK_SIZE, **filters):
+            buffer = StringIO()
+            if export_format == "jsonl":
+                for user_id, last_active, message_count, banned in chunk:
+                    buffer.write(json.dumps({"user_id": user_id, "last_active_at": last_active,
+                                             "message_count": message_count, "banned": banned}))
+                    buffer.write("\n")
+            else:
+                writer = csv.writer(buffer)
+                writer.writerows(
+                    (user_id, format_timestamp(last_active), message_count, banned)
+                    for user_id, last_active, message_count, banned in chunk
+                )
+            count += len(chunk)
+            await asyncio.to_thread(archive.write, buffer.getvalue().encode())
+    return count
+
+
+async def send_export(message: Message, export_format: str = "csv", incremental: bool = False, **filters):
+    """Выгружает пользователей во временный файл и отправляет его администратору"""
+    started = int(time.time())
+    if incremental:
+        last_export = await user_repo.store.get_meta("last_export_at")
+        filters["active_since"] = max(filters.get("active_since") or 0, int(last_export or 0))
+
+    fd, path = tempfile.mkstemp(prefix="users_export_", suffix=f".{export_format}.gz")
+    os.close(fd)
+    try:
+        count = await export_users(path, export_format, **filters)
+        if not count:
+            await message.answer("📦 Нет пользователей, подходящих под фильтр")
+            return
+        filename = f"users_{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.{export_format}.gz"
+        await message.answer_document(
+            document=FSInputFile(path, filename=filename),
+            caption=f"📦 Выгружено пользователей: {count}"
+        )
+        await user_repo.store.set_meta("last_export_at", str(started))
+    finally:
+        os.remove(path)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    """Выгрузка с фильтрами: /export jsonl days=7 min=10 banned new"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("🚫 Недостаточно прав!")
+        return
+
+    options = {"export_format": "csv", "incremental": False}
+    for arg in (command.args or "").split():
+        key, _, value = arg.partition("=")
+        if arg in ("csv", "jsonl"):
+            options["export_format"] = arg
+        elif arg == "banned":
+            options["banned_only"] = True
+        elif arg == "new":
+            options["incremental"] = True
+        elif key == "min" and value.isdigit():
+            options["min_messages"] = int(value)
+        elif key == "days" and value.isdigit():
+            options["active_since"] = int(time.time()) - int(value) * 86400
+        elif key == "since":
+            try:
+                options["active_since"] = int(datetime.datetime.strptime(value, "%Y-%m-%d").timestamp())
+            except ValueError:
+                options = None
+                break
+        else:
+            options = None
+            break
+
+    if options is None:
+        await message.answer(
+            "❌ Использование: /export [csv|jsonl] [since=ГГГГ-ММ-ДД|days=N] [min=N] [banned] [new]\n"
+            "new — только активные с момента прошлой выгрузки"
+        )
+        return
+
+    await send_export(message, **options)
+
+
+@router.message(Command("logs"))
+async def cmd_logs(message: Message, command: CommandObject):
+    """Выгрузка логов с фильтром: /logs ERROR user=123456789 limit=500"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("🚫 Недостаточно прав!")
+        return
+
+    min_level, user_id, limit = logging.NOTSET, None, 100
+    for arg in (command.args or "").split():
+        key, _, value = arg.partition("=")
+        if key == "user" and value.isdigit():
+            user_id = int(value)
+        elif key == "limit" and value.isdigit():
+            limit = min(int(value), LOG_RING_SIZE)
+        elif not value and isinstance(logging.getLevelName(arg.upper()), int):
+            min_level = logging.getLevelName(arg.upper())
+        else:
+            await message.answer("❌ Использование: /logs [DEBUG|INFO|WARNING|ERROR] [user=ID] [limit=N]")
+            return
+
+    await send_logs(message, min_level, user_id, limit)
+
+
+@router.message(F.text, StateFilter("admin_broadcast_text"))
+async def process_broadcast(message: Message, state: FSMContext):
+    """Обработка текста рассылки: задача уходит в фон, прогресс обновляется в сообщении"""
     await state.clear()
+    await broadcast_engine.submit(message.text, message.chat.id)
 
 
 @router.message(F.text, StateFilter("admin_search_user"))
 async def process_user_search(message: Message):
-    """Поиск информации о пользователе"""
-    search_query = message.text.lower()
+    """Поиск информации о пользователе по локальному индексу профилей"""
+    search_query = message.text.strip()
     found_users = []
 
-    for user_id, data in game_context.items():
-        user = await bot.get_chat(user_id)
-        if (search_query in str(user_id) or
-                search_query in user.first_name.lower() or
-                search_query in (user.last_name or "").lower()):
-            found_users.append(
-                f"👤 {user.first_name} {user.last_name or ''}\n"
-                f"🆔 ID: {user_id}\n"
-                f"📅 Последняя активность: {data.get('last_active', 'N/A')}\n"
-                f"📩 Сообщений: {data.get('message_count', 0)}\n"
-                f"🚫 Статус: {'Заблокирован' if data.get('banned') else 'Активен'}"
-            )
+    user_ids = profile_index.search(search_query)
+    # Точный ID пользователя без сохраненного профиля тоже находим
+    if not user_ids and search_query.isdigit():
+        user_ids = [int(search_query)]
+
+    for user_id in user_ids:
+        data = await user_repo.get(user_id, create=False)
+        if data is None:
+            continue
+        first_name, last_name, username, _ = profile_index.profiles.get(user_id, ("?", "", "", 0))
+        if user_id not in profile_index.profiles:
+            profile_index.schedule_refresh(user_id)
+        found_users.append(
+            f"👤 {html.escape(first_name)} {html.escape(last_name)}{f' @{username}' if username else ''}\n"
+            f"🆔 ID: {user_id}\n"
+            f"📅 Последняя активность: {format_timestamp(data.last_active)}\n"
+            f"📩 Сообщений: {data.message_count}\n"
+            f"🚫 Статус: {'Заблокирован' if data.banned else 'Активен'}"
+        )
 
     response = "🔍 Результаты поиска:\n\n" + "\n\n".join(found_users[:5]) if found_users else "❌ Пользователи не найдены"
     await message.answer(response)
@@ -534,12 +4586,11 @@ async def ban_user(message: Message, command: CommandObject):
 
     try:
         user_id = int(command.args)
-        if user_id not in game_context:
+        if not await user_repo.set_banned(user_id, True):
             await message.answer("❌ Пользователь не найден")
             return
 
-        game_context[user_id]['banned'] = True
-        await message.answer(f"✅ Пользователь {Code(str(user_id))} заблокирован", parse_mode=ParseMode.HTML)
+        await message.answer(f"✅ Пользователь <code>{user_id}</code> заблокирован", parse_mode=ParseMode.HTML)
 
     except ValueError:
         await message.answer("❌ Неверный формат ID. Пример: /ban 123456789")
@@ -552,7 +4603,9 @@ async def unban_user(message: Message, command: CommandObject):
 
     try:
         user_id = int(command.args)
-        game_context[user_id]['banned'] = False
+        if not await user_repo.set_banned(user_id, False):
+            await message.answer("❌ Пользователь не найден")
+            return
         await message.answer(f"✅ Пользователь {user_id} разблокирован")
     except:
         await message.answer("❌ Использование: /unban <user_id>")
@@ -562,32 +4615,18 @@ async def unban_user(message: Message, command: CommandObject):
 @router.message(F.text & ~F.text.startswith('/'))
 async def handle_general_message(message: Message):
     # Проверка блокировки
-    user_data = game_context.get(message.from_user.id, {})
-    if user_data.get('banned'):
+    user_data = await user_repo.get(message.from_user.id, create=False)
+    if user_data and user_data.banned:
         await message.answer("🚫 Ваш доступ к оракулу ограничен")
         return
 
 @router.callback_query(F.data == "refresh_stats")
 async def refresh_stats(callback: CallbackQuery):
     """Обновление статистики"""
-    stats = f"📊 Обновленная статистика:\nПользователей: {len(game_context)}"
-    await callback.message.edit_text(stats)
-
-async def main():
-    dp.include_router(router)
-    await dp.start_polling(bot)
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
-
-
-# Остальные обработчики остаются без изменений, но используют обновленный get_ai_response
-
-async def main():
-    dp.include_router(router)
-    await dp.start_polling(bot)
-
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("🚫 Доступ запрещен!")
+        return
+    await callback.message.edit_text(admin_stats.render(), parse_mode=ParseMode.HTML)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,351 @@
+"""Нагрузочный бенчмарк без сети: настоящие dp/router против локальных заглушек.
+
+Заглушки Telegram Bot API и LLM API (benchmarks/fakes.py) запускаются в
+отдельном процессе, синтетические апдейты подаются в dp.feed_update. Для
+каждого сценария печатаются p50/p95/p99 времени обработки апдейта и времени
+до доставки ответа оракула (задания llm_jobs), число апдейтов, отклоненных
+ограничением частоты, пропускная способность, пиковый RSS и число вызовов заглушек.
+
+Ограничение частоты по умолчанию отключено (--throttle включает), а у каждого
+сценария свой диапазон ID пользователей.
+
+Сценарии выполняются в фиксированном порядке, население пользователей растет:
+- broadcast: рассылка на --broadcast-users пользователей и диалоги на ее фоне;
+- sign: всплеск одинаковых /знак при прогретом кэше ответов;
+- dialog: /oracle с потоковыми ответами, ошибками и 429 по настройкам LLM;
+- search: поиск администратора по индексу из --search-users профилей.
+
+Запуск: python benchmarks/bench_load.py [--scenarios broadcast sign dialog search]
+        [--llm-latency 0.5] [--llm-error-rate 0.01] [--llm-429-rate 0.02] [--json report.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+FAKE_PORT = free_port()
+FAKE_URL = f"http://127.0.0.1:{FAKE_PORT}"
+
+# app.py читает настройки при импорте; все внешние адреса указывают на заглушки
+for name, value in (("BOT_TOKEN", "42:bench"), ("API_URL", f"{FAKE_URL}/v1/chat/completions"),
+                    ("API_KEY", "bench"), ("ADMIN_ID", "1"), ("DATABASE_URL", "memory://"),
+                    ("TELEGRAM_API_URL", FAKE_URL), ("METRICS_PORT", "0"), ("LOG_LEVEL", "WARNING"),
+                    ("LOG_FILE", os.path.join(tempfile.gettempdir(), "bench_load.log"))):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import aiohttp  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import app  # noqa: E402
+import fakes  # noqa: E402
+
+ADMIN_ID = app.ADMIN_ID
+BASE_USER_ID = 100_000_000
+SCENARIOS = ("broadcast", "sign", "dialog", "search")
+
+
+class UpdateFactory:
+    """Синтетические апдейты в формате Bot API"""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"Имя{user_id % 1000}",
+                "last_name": f"Фамилия{user_id % 7919}", "username": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> Update:
+        update_id = self._next_id()
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text
+            }
+        }, context={"bot": app.bot})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = self._next_id()
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "menu"
+                }
+            }
+        }, context={"bot": app.bot})
+
+
+class FakeControl:
+    """Настройка и счетчики заглушек"""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    async def configure(self, **config):
+        async with self.session.post(f"{FAKE_URL}/_config", json=config) as response:
+            response.raise_for_status()
+
+    async def reset(self):
+        async with self.session.post(f"{FAKE_URL}/_reset") as response:
+            response.raise_for_status()
+
+    async def stats(self) -> Dict[str, Dict[str, int]]:
+        async with self.session.get(f"{FAKE_URL}/_stats") as response:
+            return await response.json()
+
+
+def synthetic_user(scenario: str, index: int) -> int:
+    """Свой диапазон ID у каждого сценария: корзины ограничения частоты не переходят между сценариями"""
+    return BASE_USER_ID - 1 - SCENARIOS.index(scenario) * 1_000_000 - index
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def drive(updates: List[Update], concurrency: int) -> Dict[str, Any]:
+    """Подает апдейты в диспетчер не более concurrency одновременно и ждет доставки ответов оракула"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors: Counter = Counter()
+    app.llm_jobs.latencies.clear()
+    throttled = app.throttled_updates.total()
+
+    async def feed(update: Update):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await app.dp.feed_update(app.bot, update)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(update) for update in updates))
+    await app.llm_jobs.join()
+    elapsed = time.perf_counter() - started
+    jobs = list(app.llm_jobs.latencies)
+    return {
+        "updates": len(updates),
+        "errors": dict(errors),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(updates) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "throttled": int(app.throttled_updates.total() - throttled),
+        "jobs": len(jobs),
+        "job_p50_ms": round(percentile(jobs, 0.50) * 1000, 1),
+        "job_p95_ms": round(percentile(jobs, 0.95) * 1000, 1),
+    }
+
+
+async def seed_users(count: int, with_profiles: bool):
+    """Добавляет в хранилище пользователей до общего числа count"""
+    existing = (await app.user_repo.stats())["total"]
+    now = int(time.time())
+    for start in range(BASE_USER_ID + existing, BASE_USER_ID + count, 10_000):
+        user_ids = range(start, min(start + 10_000, BASE_USER_ID + count))
+        await app.user_repo.store.upsert({
+            user_id: app.UserContext(message_count=user_id % 50, last_active=now - user_id % 86400)
+            for user_id in user_ids
+        })
+        if with_profiles:
+            await app.user_repo.store.upsert_profiles({
+                user_id: (f"Имя{user_id % 1000}", f"Фамилия{user_id % 7919}", f"user{user_id}", now)
+                for user_id in user_ids
+            })
+
+
+async def scenario_broadcast(args, factory: UpdateFactory) -> Dict[str, Any]:
+    """Рассылка на всех пользователей; параллельно идут диалоги других пользователей"""
+    await seed_users(args.broadcast_users, with_profiles=False)
+    await app.admin_stats.load()
+    app.broadcast_engine.bucket = app.TokenBucket(args.broadcast_rate, capacity=args.broadcast_rate)
+    app.broadcast_engine.workers = args.broadcast_workers
+
+    await drive([factory.callback(ADMIN_ID, "admin_broadcast")], 1)
+    started = time.perf_counter()
+    await drive([factory.message(ADMIN_ID, "Бенчмарк рассылки")], 1)
+
+    background = [
+        factory.message(synthetic_user("broadcast", i % args.dialog_users), f"/oracle вопрос {i}")
+        for i in range(args.background_updates)
+    ]
+    result = await drive(background, args.concurrency)
+    await asyncio.gather(*list(app.broadcast_engine._tasks.values()), return_exceptions=True)
+    broadcast_seconds = time.perf_counter() - started
+    result["broadcast_seconds"] = round(broadcast_seconds, 3)
+    result["broadcast_rate"] = round(args.broadcast_users / broadcast_seconds, 1)
+    return result
+
+
+async def scenario_sign(args, factory: UpdateFactory) -> Dict[str, Any]:
+    """Одинаковые /знак от разных пользователей после прогрева кэша"""
+    await drive([factory.message(synthetic_user("sign", 0), "/знак Скорпион")], 1)
+    updates = [factory.message(synthetic_user("sign", i + 1), "/знак Скорпион") for i in range(args.sign_updates)]
+    return await drive(updates, args.concurrency)
+
+
+async def scenario_dialog(args, factory: UpdateFactory) -> Dict[str, Any]:
+    """Потоковые ответы /oracle с ошибками и 429 по настройкам заглушки LLM"""
+    updates = [
+        factory.message(synthetic_user("dialog", i % args.dialog_users), f"/oracle как пройдет день {i}?")
+        for i in range(args.dialog_updates)
+    ]
+    return await drive(updates, args.concurrency)
+
+
+async def scenario_search(args, factory: UpdateFactory) -> Dict[str, Any]:
+    """Поиск администратора по индексу профилей"""
+    await seed_users(args.search_users, with_profiles=True)
+    await app.profile_index.start()
+
+    await drive([factory.callback(ADMIN_ID, "admin_search")], 1)
+    queries = ["имя42", "фамилия17 имя5", "user1000123", "@user10000", "100000777", "нетакого"]
+    updates = [factory.message(ADMIN_ID, queries[i % len(queries)]) for i in range(args.search_updates)]
+    # Поиск выполняет один администратор - апдейты подаются последовательно
+    return await drive(updates, 1)
+
+
+async def run(args) -> Dict[str, Any]:
+    app.dp.include_router(app.router)
+    app.STREAM_RESPONSES = not args.no_stream
+    if not args.throttle:
+        # Измеряется путь ответа, а не отказы: синтетические пользователи пишут чаще живых
+        app.throttling.limits = {key: (1e9, 1e9) for key in app.throttling.limits}
+    report: Dict[str, Any] = {}
+
+    async with aiohttp.ClientSession() as session:
+        control = FakeControl(session)
+        await control.configure(
+            llm_latency=args.llm_latency, llm_jitter=args.llm_jitter, llm_error_rate=args.llm_error_rate,
+            llm_rate_limit_rate=args.llm_429_rate, llm_chunks=args.llm_chunks,
+            tg_latency=args.tg_latency, tg_rate_limit_rate=args.tg_429_rate, tg_blocked_rate=args.tg_blocked_rate
+        )
+
+        await app.user_repo.start()
+        await app.api_client.start()
+        await app.broadcast_engine.start()
+        await app.llm_jobs.start()
+        factory = UpdateFactory()
+        try:
+            for name in SCENARIOS:
+                if name not in args.scenarios:
+                    continue
+                await control.reset()
+                result = await globals()[f"scenario_{name}"](args, factory)
+                stats = await control.stats()
+                result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+                result["llm_calls"] = stats["llm"]
+                result["bot_api_calls"] = stats["telegram"]
+                report[name] = result
+                print_result(name, result)
+        finally:
+            await app.cleanup()
+    return report
+
+
+def print_result(name: str, result: Dict[str, Any]):
+    print(f"\n== {name} ==")
+    print(f"  updates {result['updates']}, errors {result['errors']}, {result['seconds']}s, "
+          f"{result['throughput']} upd/s")
+    print(f"  latency p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+          f"throttled {result['throttled']}")
+    if result["jobs"]:
+        print(f"  oracle answers {result['jobs']}, p50 {result['job_p50_ms']} ms, p95 {result['job_p95_ms']} ms")
+    if "broadcast_seconds" in result:
+        print(f"  broadcast {result['broadcast_seconds']}s, {result['broadcast_rate']} msg/s")
+    print(f"  peak RSS {result['peak_rss_mb']} MB")
+    print(f"  LLM calls {result['llm_calls']}")
+    print(f"  Bot API calls {result['bot_api_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=500, help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--broadcast-users", type=int, default=10_000)
+    parser.add_argument("--broadcast-rate", type=float, default=2000, help="лимит рассылки, сообщений/с")
+    parser.add_argument("--broadcast-workers", type=int, default=app.BROADCAST_WORKERS)
+    parser.add_argument("--background-updates", type=int, default=500)
+    parser.add_argument("--sign-updates", type=int, default=5000)
+    parser.add_argument("--dialog-updates", type=int, default=1000)
+    parser.add_argument("--dialog-users", type=int, default=300)
+    parser.add_argument("--search-users", type=int, default=100_000)
+    parser.add_argument("--search-updates", type=int, default=300)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-429-rate", type=float, default=0.0)
+    parser.add_argument("--llm-chunks", type=int, default=20)
+    parser.add_argument("--no-stream", action="store_true", help="ответы без потоковой выдачи")
+    parser.add_argument("--throttle", action="store_true",
+                        help="оставить ограничения частоты THROTTLE_* (по умолчанию отключены)")
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--tg-429-rate", type=float, default=0.0)
+    parser.add_argument("--tg-blocked-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="сохранить отчет в JSON")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=fakes.serve, args=("127.0.0.1", FAKE_PORT, ready), daemon=True)
+    server.start()
+    if not ready.wait(timeout=30):
+        sys.exit("Fake server did not start")
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
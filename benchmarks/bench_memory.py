@@ -0,0 +1,92 @@
+"""Замер памяти на пользователя для разных представлений контекста.
+
+Сравнивает прежний формат (словарь со списком словарей и строковой датой),
+компактный UserContext в горячем кэше и выгруженные записи MemoryUserStore.
+
+Запуск: python benchmarks/bench_memory.py [--users 10000 100000 1000000] [--history 2]
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+# app.py проверяет переменные окружения при импорте
+for name, value in (("BOT_TOKEN", "0:bench"), ("API_URL", "http://127.0.0.1/v1/chat/completions"),
+                    ("API_KEY", "bench"), ("ADMIN_ID", "1"), ("DATABASE_URL", "memory://")):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+BASE_USER_ID = 100_000_000
+
+
+def synthetic_turns(user_id: int, history: int):
+    for i in range(history):
+        role = "user" if i % 2 == 0 else "assistant"
+        yield role, f"реплика {i} пользователя {user_id}"
+
+
+def legacy_context(user_id: int, history: int) -> dict:
+    return {
+        "messages": [{"role": role, "content": content} for role, content in synthetic_turns(user_id, history)],
+        "message_count": history // 2,
+        "last_active": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "banned": False
+    }
+
+
+def compact_context(user_id: int, history: int) -> app.UserContext:
+    return app.UserContext(synthetic_turns(user_id, history), message_count=history // 2,
+                           last_active=int(time.time()) - user_id % 86400)
+
+
+def measure(build, users: int) -> float:
+    """Байт на пользователя для словаря {user_id: build(user_id)}"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = {}
+    for user_id in range(BASE_USER_ID, BASE_USER_ID + users):
+        table[user_id] = build(user_id)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del table
+    return (after - before) / users
+
+
+def measure_spilled(users: int, history: int) -> float:
+    """Байт на пользователя, выгруженного из горячего кэша в MemoryUserStore"""
+    store = app.MemoryUserStore()
+    contexts = {user_id: compact_context(user_id, history) for user_id in range(BASE_USER_ID, BASE_USER_ID + users)}
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    asyncio.run(store.upsert(contexts))
+    contexts.clear()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--history", type=int, default=2, help="реплик в истории каждого пользователя")
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'legacy dict':>14} {'UserContext':>14} {'spilled row':>14}  (bytes/user, history={args.history})")
+    for users in args.users:
+        legacy = measure(lambda user_id: legacy_context(user_id, args.history), users)
+        compact = measure(lambda user_id: compact_context(user_id, args.history), users)
+        spilled = measure_spilled(users, args.history)
+        print(f"{users:>10} {legacy:>14.0f} {compact:>14.0f} {spilled:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
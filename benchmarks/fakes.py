@@ -0,0 +1,224 @@
+"""Локальные заглушки Telegram Bot API и LLM API для бенчмарков.
+
+Один aiohttp-сервер обслуживает:
+- /bot{token}/{method} - Bot API с настраиваемой задержкой, 429 и 403; слишком длинный
+  текст и неверная разметка HTML отклоняются, как в Telegram;
+- /v1/chat/completions - chat completions с задержкой, ошибками 5xx, 429 и потоковой выдачей (SSE);
+- /_config (POST), /_stats (GET), /_reset (POST) - управление и счетчики вызовов;
+- /_updates (POST) - список апдейтов, которые бот получит через getUpdates.
+
+Запуск отдельно: python benchmarks/fakes.py --port 8081
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from aiohttp import web
+
+DEFAULT_CONFIG = {
+    "llm_latency": 0.5,  # время до первого токена, сек
+    "llm_jitter": 0.2,  # случайная добавка к задержке, сек
+    "llm_error_rate": 0.0,  # доля ответов 500
+    "llm_rate_limit_rate": 0.0,  # доля ответов 429
+    "llm_retry_after": 1,  # Retry-After для 429, сек
+    "llm_chunks": 20,  # число фрагментов потокового ответа
+    "llm_chunk_delay": 0.05,  # пауза между фрагментами, сек
+    "llm_response_chars": 600,
+    "llm_response_text": None,  # Повторяемый фрагмент ответа (по умолчанию RESPONSE_TEXT)
+    "tg_latency": 0.02,  # задержка ответа Bot API, сек
+    "tg_rate_limit_rate": 0.0,  # доля ответов 429 на sendMessage
+    "tg_retry_after": 1,
+    "tg_blocked_rate": 0.0,  # доля ответов 403 на sendMessage
+}
+
+# Методы, которые возвращают объект Message
+MESSAGE_METHODS = {"sendmessage", "editmessagetext", "senddocument", "sendphoto", "forwardmessage"}
+
+MESSAGE_LIMIT = 4096
+# Грубая проверка разметки HTML: неизвестный тег или «&» не в начале сущности
+BAD_HTML = re.compile(r"<(?!/?(b|strong|i|em|u|ins|s|strike|del|code|pre|a|tg-spoiler|blockquote)\b)|&(?!(lt|gt|amp|quot|#\d+);)")
+
+RESPONSE_TEXT = "Звезды сходятся в узор, и древние знаки указывают путь. "
+
+
+class FakeServer:
+    def __init__(self):
+        self.config = dict(DEFAULT_CONFIG)
+        self.llm_calls: Counter = Counter()
+        self.tg_calls: Counter = Counter()
+        self._message_id = 0
+        self.updates: list = []  # Апдейты для getUpdates
+        self._updates_added = asyncio.Event()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.handle_completion)
+        app.router.add_post("/bot{token}/{method}", self.handle_bot_api)
+        app.router.add_post("/_config", self.handle_config)
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_post("/_reset", self.handle_reset)
+        app.router.add_post("/_updates", self.handle_add_updates)
+        return app
+
+    async def _delay(self, base: float, jitter: float = 0.0):
+        delay = base + random.random() * jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # LLM API
+    def _response_text(self) -> str:
+        chars = self.config["llm_response_chars"]
+        text = self.config["llm_response_text"] or RESPONSE_TEXT
+        return (text * (chars // len(text) + 1))[:chars]
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        stream = bool(payload.get("stream"))
+        await self._delay(self.config["llm_latency"], self.config["llm_jitter"])
+
+        roll = random.random()
+        if roll < self.config["llm_rate_limit_rate"]:
+            self.llm_calls["429"] += 1
+            return web.json_response({"error": {"message": "rate limited"}}, status=429,
+                                     headers={"Retry-After": str(self.config["llm_retry_after"])})
+        if roll < self.config["llm_rate_limit_rate"] + self.config["llm_error_rate"]:
+            self.llm_calls["500"] += 1
+            return web.json_response({"error": {"message": "internal error"}}, status=500)
+
+        self.llm_calls["stream" if stream else "200"] += 1
+        text = self._response_text()
+        prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4,
+                 "total_tokens": prompt_tokens + len(text) // 4}
+        if not stream:
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunks = max(1, self.config["llm_chunks"])
+        size = len(text) // chunks + 1
+        for i in range(0, len(text), size):
+            event = {"choices": [{"index": 0, "delta": {"content": text[i:i + size]}}]}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+            await self._delay(self.config["llm_chunk_delay"])
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    # Telegram Bot API
+    def _message(self, chat_id, text=None) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "text": text or ""
+        }
+
+    async def handle_bot_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        lowered = method.lower()
+        self.tg_calls[method] += 1
+        params = dict(await request.post())
+        await self._delay(self.config["tg_latency"])
+
+        if lowered in ("sendmessage", "editmessagetext"):
+            text = params.get("text", "")
+            if len(text.encode("utf-16-le")) // 2 > MESSAGE_LIMIT:
+                return web.json_response({"ok": False, "error_code": 400,
+                                          "description": "Bad Request: message is too long"}, status=400)
+            if params.get("parse_mode") == "HTML" and BAD_HTML.search(text):
+                return web.json_response({"ok": False, "error_code": 400,
+                                          "description": "Bad Request: can't parse entities"}, status=400)
+
+        if lowered == "sendmessage":
+            roll = random.random()
+            if roll < self.config["tg_rate_limit_rate"]:
+                retry_after = self.config["tg_retry_after"]
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after}
+                }, status=429)
+            if roll < self.config["tg_rate_limit_rate"] + self.config["tg_blocked_rate"]:
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+                }, status=403)
+
+        if lowered == "getupdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        if lowered in MESSAGE_METHODS:
+            result = self._message(params.get("chat_id"), params.get("text"))
+        elif lowered == "getchat":
+            chat_id = int(params.get("chat_id", 0))
+            result = {"id": chat_id, "type": "private", "first_name": f"User{chat_id}",
+                      "accent_color_id": 0, "max_reaction_count": 0}
+        elif lowered == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> list:
+        """Long polling: отдает апдейты начиная с offset, без них ждет до timeout"""
+        offset = int(params.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self._updates_added.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._updates_added.wait(), float(params.get("timeout") or 0))
+        return self.updates[:int(params.get("limit") or 100)]
+
+    # Управление
+    async def handle_config(self, request: web.Request) -> web.Response:
+        self.config.update(await request.json())
+        return web.json_response(self.config)
+
+    async def handle_add_updates(self, request: web.Request) -> web.Response:
+        self.updates.extend(await request.json())
+        self._updates_added.set()
+        return web.json_response({"ok": True, "pending": len(self.updates)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"llm": dict(self.llm_calls), "telegram": dict(self.tg_calls)})
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.llm_calls.clear()
+        self.tg_calls.clear()
+        return web.json_response({"ok": True})
+
+
+async def _serve(host: str, port: int, ready=None):
+    runner = web.AppRunner(FakeServer().build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    if ready is not None:
+        ready.set()
+    await asyncio.Event().wait()
+
+
+def serve(host: str, port: int, ready=None):
+    """Точка входа для отдельного процесса"""
+    try:
+        asyncio.run(_serve(host, port, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    print(f"Bot API: http://{args.host}:{args.port}  LLM: http://{args.host}:{args.port}/v1/chat/completions")
+    serve(args.host, args.port)